@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from botocore.exceptions import ClientError
+
+SCENARIOS = ["logstreams", "fetch", "enrich", "cycle", "tail"]
+PAGE_SIZE = 1000
+BASE_EPOCHTIME = 1600000000
+
+#synthetic VPC flow log records, destinations and ENIs drawn with zipf-like skew
+class FlowGenerator:
+    def __init__(self, enis=50, destinations=5000, skew=1.1, accept_ratio=0.9,
+            egress_ratio=0.7, seed=1):
+        self.rng = random.Random(seed)
+        self.accept_ratio = accept_ratio
+        self.egress_ratio = egress_ratio
+        self.enis = ["eni-%08x" % i for i in range(enis)]
+        self.src_ips = ["10.%d.%d.%d" % (i // 65536 % 256, i // 256 % 256, i % 256 + 1) for i in range(enis)]
+        self.destinations = ["%d.%d.%d.%d" % (self.rng.randint(11, 223), self.rng.randint(0, 255),
+            self.rng.randint(0, 255), self.rng.randint(1, 254)) for i in range(destinations)]
+        self.dst_weights = self.cum_weights(destinations, skew)
+        self.eni_weights = self.cum_weights(enis, skew)
+
+    def cum_weights(self, count, skew):
+        total = 0.0
+        weights = []
+        for rank in range(1, count + 1):
+            total += 1.0 / (rank ** skew)
+            weights.append(total)
+        return weights
+
+    def record(self, eni_index, flow_start):
+        rng = self.rng
+        if rng.random() < self.egress_ratio:
+            dstaddr = rng.choices(self.destinations, cum_weights=self.dst_weights)[0]
+        else:
+            dstaddr = "10.%d.%d.%d" % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+        action = "ACCEPT" if rng.random() < self.accept_ratio else "REJECT"
+        packets = rng.randint(1, 500)
+        return "2 123456789012 %s %s %s %d %d 6 %d %d %d %d %s OK" % (
+            self.enis[eni_index], self.src_ips[eni_index], dstaddr,
+            rng.randint(1024, 65535), rng.choice([443, 80, 53, 22, 8080]),
+            packets, packets * rng.randint(40, 1500), flow_start, flow_start + 60, action)
+
+    #events per LogStream, as filter_log_events returns them
+    def events(self, count, start_time=BASE_EPOCHTIME, duration=3600):
+        streams = dict((eni, []) for eni in self.enis)
+        for i in range(count):
+            eni_index = self.rng.choices(range(len(self.enis)), cum_weights=self.eni_weights)[0]
+            flow_start = start_time + i * duration // max(1, count)
+            message = self.record(eni_index, flow_start)
+            streams[self.enis[eni_index]].append({
+                "logStreamName": self.enis[eni_index] + "-all",
+                "timestamp": flow_start * 1000,
+                "ingestionTime": (flow_start + 600) * 1000,
+                "message": message,
+                "eventId": "%056d" % (flow_start * 1000000 + i)})
+        return dict((eni + "-all", events) for eni, events in streams.items())
+
+class ApiStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttles = {}
+
+    def call(self, api, latency, throttle_rate, rng):
+        with self.lock:
+            self.calls[api] = self.calls.get(api, 0) + 1
+            throttled = rng.random() < throttle_rate
+            if throttled:
+                self.throttles[api] = self.throttles.get(api, 0) + 1
+        if latency:
+            time.sleep(latency)
+        if throttled:
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, api)
+
+#pages by calling the client method again with the response token, like
+#botocore paginators do
+class FakePaginator:
+    def __init__(self, method, token_name):
+        self.method = method
+        self.token_name = token_name
+
+    def paginate(self, **kwargs):
+        token = (kwargs.pop("PaginationConfig", None) or {}).get("StartingToken")
+        while True:
+            if token:
+                kwargs[self.token_name] = token
+            page = self.method(**kwargs)
+            yield page
+            token = page.get(self.token_name)
+            if not token:
+                return
+
+def page_of(items, token, size):
+    offset = int(token or 0)
+    page = items[offset:offset + size]
+    next_token = str(offset + size) if offset + size < len(items) else None
+    return page, next_token
+
+#in-process stand-in for boto3.client('logs')
+class FakeLogsClient:
+    def __init__(self, streams, stats, latency=0.0, throttle_rate=0.0, seed=1):
+        self.streams = streams
+        self.stats = stats
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+
+    def get_paginator(self, name):
+        return FakePaginator(getattr(self, name), "nextToken")
+
+    def describe_log_streams(self, **kwargs):
+        self.stats.call("describe_log_streams", self.latency, self.throttle_rate, self.rng)
+        lstreams = [{"logStreamName": name,
+            "firstEventTimestamp": events[0]["timestamp"] if events else 0,
+            "lastEventTimestamp": events[-1]["timestamp"] if events else 0}
+            for name, events in self.streams.items()]
+        lstreams.sort(key=lambda lstream: lstream["lastEventTimestamp"],
+            reverse=kwargs.get("descending", False))
+        page, next_token = page_of(lstreams, kwargs.get("nextToken"), 50)
+        response = {"logStreams": page}
+        if next_token:
+            response["nextToken"] = next_token
+        return response
+
+    #one stream per call, as the service asks for
+    def filter_log_events(self, **kwargs):
+        import get_flowlogs
+        self.stats.call("filter_log_events", self.latency, self.throttle_rate, self.rng)
+        start = kwargs.get("startTime", 0)
+        end = kwargs.get("endTime", float("inf"))
+        events = [event for name in kwargs.get("logStreamNames", [])
+            for event in self.streams.get(name, [])
+            if start <= event["timestamp"] <= end
+            and get_flowlogs.is_egress_flow(event["message"].split(' '))]
+        page, next_token = page_of(events, kwargs.get("nextToken"), PAGE_SIZE)
+        response = {"events": page}
+        if next_token:
+            response["nextToken"] = next_token
+        return response
+
+    #forward tokens are offsets, the last one comes back at the end of the stream
+    def get_log_events(self, **kwargs):
+        self.stats.call("get_log_events", self.latency, self.throttle_rate, self.rng)
+        events = self.streams.get(kwargs["logStreamName"], [])
+        token = kwargs.get("nextToken")
+        if token is None:
+            start = kwargs.get("startTime", 0)
+            token = "f/%d" % len([event for event in events if event["timestamp"] < start])
+        offset = int(token[2:])
+        page = events[offset:offset + kwargs.get("limit", 10000)]
+        return {"events": page, "nextForwardToken": "f/%d" % (offset + len(page))}
+
+#in-process stand-in for boto3.client('ec2')
+class FakeEc2Client:
+    def __init__(self, generator, stats, latency=0.0, throttle_rate=0.0, seed=1):
+        self.stats = stats
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rng = random.Random(seed)
+        self.instances = [{"InstanceId": "i-%017x" % i, "InstanceType": "m5.large",
+            "PrivateIpAddress": ip, "SubnetId": "subnet-0001", "ImageId": "ami-0001",
+            "VpcId": "vpc-0001", "Tags": [{"Key": "Name", "Value": "bench-%d" % i}],
+            "NetworkInterfaces": [{"NetworkInterfaceId": generator.enis[i],
+                "PrivateIpAddresses": [{"PrivateIpAddress": ip}]}]}
+            for i, ip in enumerate(generator.src_ips)]
+
+    def get_paginator(self, name):
+        return FakePaginator(self.describe_instances, "NextToken")
+
+    def describe_instances(self, Filters=None, NextToken=None):
+        self.stats.call("describe_instances", self.latency, self.throttle_rate, self.rng)
+        instances = self.instances
+        for instance_filter in Filters or []:
+            if instance_filter["Name"] == "private-ip-address":
+                instances = [instance for instance in instances
+                    if instance["PrivateIpAddress"] in instance_filter["Values"]]
+        page, next_token = page_of(instances, NextToken, PAGE_SIZE)
+        response = {"Reservations": [{"Instances": page}]}
+        if next_token:
+            response["NextToken"] = next_token
+        return response
+
+def fake_dns_resolver(latency, nx_ratio, seed):
+    rng = random.Random(seed)
+    def resolve(ip):
+        if latency:
+            time.sleep(latency)
+        if rng.random() < nx_ratio:
+            raise OSError("NXDOMAIN")
+        return "host-" + ip.replace(".", "-") + ".example.com"
+    return resolve
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+class StopBenchmark(Exception):
+    pass
+
+def setup_service(args, state_dir):
+    os.environ["VPC_LOG_GROUP_NAME"] = "bench-flowlogs"
+    os.environ["AWS_VPC_ID"] = "vpc-0001"
+    os.environ["SLEEP"] = "0"
+    os.environ["START_READING_LOGS_EPOCHTIME"] = str(BASE_EPOCHTIME)
+    os.environ["DNS_MODE"] = args.dns_mode
+    #0: the fakes are not rate limited unless asked to
+    for api in ("DESCRIBE_LOG_STREAMS", "FILTER_LOG_EVENTS", "DESCRIBE_INSTANCES", "GET_LOG_EVENTS"):
+        os.environ["API_RATE_" + api] = str(args.api_rate)
+    import get_flowlogs
+    from flowlog_dns import ReverseDnsResolver
+    get_flowlogs.STATE_DIR = state_dir
+    #measures instrumentation overhead when on
+    get_flowlogs.metrics.enabled = args.metrics
+    get_flowlogs.set_doc_output(open(os.devnull, "w"))
+    get_flowlogs.dns_resolver = ReverseDnsResolver(
+        fake_dns_resolver(args.dns_latency / 1000.0, args.dns_nx_ratio, args.seed),
+        mode=args.dns_mode)
+    return get_flowlogs
+
+def run_scenario(scenario, args):
+    #service INFO lines would drown the results
+    sys.stdout = open(os.devnull, "w")
+    generator = FlowGenerator(args.enis, args.destinations, args.skew,
+        args.accept_ratio, args.egress_ratio, args.seed)
+    streams = generator.events(args.events)
+    stats = ApiStats()
+    latency = args.api_latency / 1000.0
+    fakes = [FakeLogsClient(streams, stats, latency, 0.0, args.seed),
+        FakeEc2Client(generator, stats, latency, 0.0, args.seed)]
+    state_dir = tempfile.mkdtemp(prefix="flowlog_bench")
+    get_flowlogs = setup_service(args, state_dir)
+    #same call scheduler as the service puts in front of boto3
+    clients = [get_flowlogs.scheduled(fake) for fake in fakes]
+    lstreams_list = get_flowlogs.get_logstreams(clients, BASE_EPOCHTIME)
+    get_flowlogs.get_ec2_index(clients).refresh_if_stale()
+    stats.calls.clear()
+    stats.throttles.clear()
+    #warm-up above runs unthrottled
+    fakes[0].throttle_rate = args.throttle_rate
+    fakes[1].throttle_rate = args.throttle_rate
+
+    latencies = []
+    count = 0
+    started = time.perf_counter()
+    if scenario == "logstreams":
+        for i in range(args.repeat):
+            t0 = time.perf_counter()
+            count += len(get_flowlogs.get_logstreams(clients, BASE_EPOCHTIME))
+            latencies.append(time.perf_counter() - t0)
+    elif scenario == "fetch":
+        t0 = time.perf_counter()
+        for event in get_flowlogs.get_eve_per_logstream(clients, lstreams_list,
+                BASE_EPOCHTIME, BASE_EPOCHTIME + 7200):
+            t1 = time.perf_counter()
+            latencies.append(t1 - t0)
+            t0 = t1
+            count += 1
+    elif scenario == "enrich":
+        messages = [event["message"] for events in streams.values() for event in events
+            if get_flowlogs.is_egress_flow(event["message"].split(' '))]
+        started = time.perf_counter()
+        for message in messages:
+            t0 = time.perf_counter()
+            get_flowlogs.enrich_push_logs(clients, message)
+            latencies.append(time.perf_counter() - t0)
+        count = len(messages)
+    elif scenario == "cycle":
+        real_time = get_flowlogs.time
+        cycles = [0]
+        def bench_sleep(seconds):
+            cycles[0] += 1
+            if cycles[0] >= args.cycles:
+                raise StopBenchmark()
+        get_flowlogs.time = types.SimpleNamespace(time=real_time.time, sleep=bench_sleep,
+            strftime=real_time.strftime, localtime=real_time.localtime)
+        enrich = get_flowlogs.enrich_push_logs
+        def timed_enrich(clients, message):
+            t0 = time.perf_counter()
+            enrich(clients, message)
+            latencies.append(time.perf_counter() - t0)
+        get_flowlogs.enrich_push_logs = timed_enrich
+        try:
+            get_flowlogs.run_as_service(clients)
+        except StopBenchmark:
+            pass
+        finally:
+            get_flowlogs.time = real_time
+            get_flowlogs.enrich_push_logs = enrich
+        count = len(latencies)
+    elif scenario == "tail":
+        #until every event has been read once through the stream cursors
+        total = sum(len(events) for events in streams.values())
+        enrich = get_flowlogs.enrich_push_logs
+        def timed_enrich(clients, message):
+            t0 = time.perf_counter()
+            enrich(clients, message)
+            latencies.append(time.perf_counter() - t0)
+            if len(latencies) >= total:
+                raise StopBenchmark()
+        get_flowlogs.enrich_push_logs = timed_enrich
+        try:
+            get_flowlogs.run_tail(clients)
+        except StopBenchmark:
+            pass
+        finally:
+            get_flowlogs.enrich_push_logs = enrich
+        count = len(latencies)
+    elapsed = time.perf_counter() - started
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+    api_calls = sum(stats.calls.values())
+    return {
+        "scenario": scenario,
+        "events": count,
+        "seconds": round(elapsed, 6),
+        "events_per_sec": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 4),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 4),
+        "api_calls": dict(stats.calls),
+        "api_throttles": dict(stats.throttles),
+        "api_scheduler": get_flowlogs.get_call_scheduler().stats(),
+        "api_calls_per_event": round(api_calls / count, 6) if count else 0.0,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for get_flowlogs.py with stubbed AWS")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+        help="scenario to run, repeatable, default all")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--enis", type=int, default=50)
+    parser.add_argument("--destinations", type=int, default=5000)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--accept-ratio", type=float, default=0.9)
+    parser.add_argument("--egress-ratio", type=float, default=0.7)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="ms per AWS API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of AWS calls throttled")
+    parser.add_argument("--api-rate", type=float, default=0, help="scheduler calls/sec per AWS API, 0 unlimited")
+    parser.add_argument("--dns-latency", type=float, default=0.0, help="ms per PTR lookup")
+    parser.add_argument("--dns-nx-ratio", type=float, default=0.3)
+    parser.add_argument("--dns-mode", default="inline")
+    parser.add_argument("--repeat", type=int, default=10, help="listings for the logstreams scenario")
+    parser.add_argument("--cycles", type=int, default=1, help="run_as_service cycles for the cycle scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--metrics", action="store_true", help="run with hot-path metrics enabled")
+    parser.add_argument("--output", help="JSON results file, default stdout")
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "params": vars(args), "results": []}
+    #each scenario in a fresh process so peak RSS and caches are its own
+    ctx = multiprocessing.get_context("spawn")
+    for scenario in args.scenario or SCENARIOS:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_scenario, (scenario, args))
+        results["results"].append(result)
+        print ("INFO:", json.dumps(result), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        print (json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+from flowlog_sketch import BloomFilter, key_hashes
+
+CHECKPOINT_FILE = "checkpoints.json"
+CHECKPOINT_FLUSH_EVENTS = 5000
+CHECKPOINT_FLUSH_INTERVAL = 10
+DEDUP_BUCKET = 300
+DEDUP_CAPACITY = 10000
+DEDUP_ERROR = 0.000001
+
+#write-temp + fsync + rename, readers see either the old or the new file
+def atomic_write(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+#eventIds are fixed width decimal strings, increasing within a LogStream
+def event_id_after(event_id, last_event_id):
+    if last_event_id is None:
+        return True
+    if len(event_id) != len(last_event_id):
+        return len(event_id) > len(last_event_id)
+    return event_id > last_event_id
+
+#eventIds processed, in Bloom filters per DEDUP_BUCKET of event time; a
+#bucket's filters double in capacity as it fills, buckets before the oldest
+#window that can still be re-read are dropped. Saved as one file per bucket
+#plus meta.json in a directory, only the buckets changed since are rewritten
+class EventDeduper:
+    def __init__(self, bucket=DEDUP_BUCKET, capacity=DEDUP_CAPACITY, error_rate=DEDUP_ERROR):
+        self.bucket = bucket
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.buckets = {}
+        #events before floor (epoch seconds) are not covered, nor any from
+        #before since, when recording started
+        self.floor = None
+        self.since = None
+        self.dirty = False
+        self.changed = set()
+
+    def covers(self, timestamp):
+        return self.floor is not None and timestamp // 1000 >= self.floor
+
+    def add(self, event_id, timestamp):
+        bucket = timestamp // 1000 // self.bucket
+        filters = self.buckets.setdefault(bucket, [])
+        if not filters or filters[-1].count >= filters[-1].capacity:
+            filters.append(BloomFilter(self.capacity * 2 ** len(filters), self.error_rate))
+        filters[-1].add(key_hashes(event_id))
+        self.changed.add(bucket)
+        self.dirty = True
+
+    def seen(self, event_id, timestamp):
+        hashes = key_hashes(event_id)
+        return any(hashes in bloom for bloom in self.buckets.get(timestamp // 1000 // self.bucket, []))
+
+    def prune(self, floor):
+        self.floor = max(floor, self.since)
+        for bucket in [bucket for bucket in self.buckets if (bucket + 1) * self.bucket <= floor]:
+            del self.buckets[bucket]
+            self.changed.discard(bucket)
+            self.dirty = True
+
+    def bucket_path(self, directory, bucket):
+        return os.path.join(directory, "%d.bloom" % bucket)
+
+    #changed buckets first, then meta.json naming the buckets in use, then
+    #the files of dropped buckets are removed
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for bucket in self.changed:
+            path = self.bucket_path(directory, bucket)
+            with open(path + ".tmp", "wb") as fh:
+                fh.write(json.dumps([[bloom.capacity, bloom.count]
+                    for bloom in self.buckets[bucket]]).encode() + b"\n")
+                for bloom in self.buckets[bucket]:
+                    fh.write(bloom.bits)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(path + ".tmp", path)
+        atomic_write(os.path.join(directory, "meta.json"), json.dumps({"floor": self.floor,
+            "since": self.since, "bucket": self.bucket, "error_rate": self.error_rate,
+            "buckets": sorted(self.buckets)}))
+        for name in os.listdir(directory):
+            if name.endswith(".bloom") and int(name[:-len(".bloom")]) not in self.buckets:
+                os.remove(os.path.join(directory, name))
+        self.changed = set()
+        self.dirty = False
+
+    def load(self, directory):
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path, "r") as fh:
+            header = json.load(fh)
+        if header["bucket"] != self.bucket or header["error_rate"] != self.error_rate:
+            print ("INFO: ignoring", directory, "written with other DEDUP settings")
+            return False
+        buckets = {}
+        for bucket in header["buckets"]:
+            with open(self.bucket_path(directory, bucket), "rb") as fh:
+                filters = buckets[bucket] = []
+                for capacity, count in json.loads(fh.readline()):
+                    bloom = BloomFilter(capacity, self.error_rate)
+                    bloom.bits[:] = fh.read(len(bloom.bits))
+                    bloom.count = count
+                    filters.append(bloom)
+        self.buckets = buckets
+        self.floor = header["floor"]
+        self.since = header["since"]
+        return True
+
+    def stats(self):
+        return {
+            "buckets": len(self.buckets),
+            "filters": sum(len(filters) for filters in self.buckets.values()),
+            "bytes": sum(len(bloom.bits) for filters in self.buckets.values() for bloom in filters),
+        }
+
+#committed high-water mark per LogStream plus the window being processed,
+#kept in memory and flushed in batches
+class CheckpointStore:
+    def __init__(self, path, flush_events=CHECKPOINT_FLUSH_EVENTS,
+            flush_interval=CHECKPOINT_FLUSH_INTERVAL, keep_tokens=False, deduper=None, grace=0,
+            before_flush=None, idle_after=None):
+        self.path = path
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+        self.keep_tokens = keep_tokens
+        #with overlapping windows events up to grace seconds before the
+        #high-water mark are re-read, deduper tells which were processed
+        self.deduper = deduper
+        self.grace = grace
+        #called before every write, so no checkpoint gets ahead of the output
+        #of the events it covers
+        self.before_flush = before_flush
+        #streams without events for idle_after seconds before the committed
+        #window are forgotten, a deleted or handed over stream does not stay
+        self.idle_after = idle_after
+        self.state = {"window_start": None, "window_end": None, "streams": {}}
+        self.dirty = 0
+        self.flushed_at = time.time()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, "r") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError) as e:
+            print ("EXCEPTION: could not read checkpoints", self.path, ":", e)
+            return False
+        self.state["window_start"] = state.get("window_start")
+        self.state["window_end"] = state.get("window_end")
+        self.state["streams"] = state.get("streams", {})
+        print ("INFO: loaded checkpoints for", len(self.state["streams"]), "LogStreams")
+        if self.deduper is not None:
+            try:
+                self.deduper.load(self.path + ".dedup")
+            except (OSError, ValueError, KeyError) as e:
+                print ("EXCEPTION: could not read", self.path + ".dedup", ":", e)
+        return True
+
+    def window_in_progress(self):
+        if self.state["window_start"] is None or self.state["window_end"] is None:
+            return None
+        return (self.state["window_start"], self.state["window_end"])
+
+    def committed_start(self):
+        return self.state["window_start"]
+
+    def stream(self, stream_name):
+        return self.state["streams"].get(stream_name)
+
+    def is_processed(self, stream_name, timestamp, event_id):
+        checkpoint = self.state["streams"].get(stream_name)
+        if checkpoint is None:
+            return False
+        if timestamp != checkpoint["timestamp"]:
+            processed = timestamp < checkpoint["timestamp"]
+        else:
+            processed = not event_id_after(event_id, checkpoint.get("event_id"))
+        #up to a taken over mark the eventIds are in the other worker's filters
+        seeded = checkpoint.get("seeded")
+        if (processed and self.deduper is not None and self.deduper.covers(timestamp)
+                and (seeded is None or timestamp > seeded)):
+            return self.deduper.seen(event_id, timestamp)
+        return processed
+
+    #not processed yet but older than what was, i.e. ingested late
+    def is_late(self, stream_name, timestamp):
+        checkpoint = self.state["streams"].get(stream_name)
+        return checkpoint is not None and timestamp < checkpoint["timestamp"]
+
+    def advance(self, stream_name, timestamp, event_id):
+        if self.deduper is not None:
+            self.deduper.add(event_id, timestamp)
+        checkpoint = self.state["streams"].get(stream_name)
+        if checkpoint is None:
+            checkpoint = {"timestamp": timestamp, "event_id": event_id}
+            self.state["streams"][stream_name] = checkpoint
+        elif timestamp > checkpoint["timestamp"] or (timestamp == checkpoint["timestamp"]
+                and event_id_after(event_id, checkpoint.get("event_id"))):
+            checkpoint["timestamp"] = timestamp
+            checkpoint["event_id"] = event_id
+        self.dirty += 1
+        self.maybe_flush()
+
+    #token of the last fully processed page, only valid inside the same window
+    #and with the same startTime the query was made with
+    def set_token(self, stream_name, token, query_start=None):
+        if not self.keep_tokens:
+            return
+        checkpoint = self.state["streams"].setdefault(stream_name, {"timestamp": 0, "event_id": None})
+        checkpoint["next_token"] = token
+        checkpoint["token_start"] = query_start
+        self.dirty += 1
+
+    def token(self, stream_name):
+        checkpoint = self.state["streams"].get(stream_name)
+        if checkpoint is None or not self.keep_tokens:
+            return None
+        return checkpoint.get("next_token")
+
+    def clear_tokens(self):
+        for checkpoint in self.state["streams"].values():
+            checkpoint.pop("next_token", None)
+            checkpoint.pop("token_start", None)
+
+    #checkpoint of a stream taken over from another worker, whose windows
+    #ended at checkpoint["until"] (ms); kept until a window is committed.
+    #Its high-water mark is trusted as is ("seeded") until the grace
+    #re-reads have moved past it
+    def seed(self, stream_name, checkpoint):
+        current = self.state["streams"].get(stream_name)
+        if current is None or checkpoint.get("timestamp", 0) > current["timestamp"]:
+            current = {"timestamp": checkpoint.get("timestamp", 0),
+                "event_id": checkpoint.get("event_id"), "seeded": checkpoint.get("timestamp", 0)}
+            self.state["streams"][stream_name] = current
+        if checkpoint.get("until") is not None:
+            current["until"] = checkpoint["until"]
+        self.dirty += 1
+
+    def begin_window(self, start_time, end_time):
+        if (start_time, end_time) != self.window_in_progress():
+            self.clear_tokens()
+        self.state["window_start"] = start_time
+        self.state["window_end"] = end_time
+        if self.deduper is not None:
+            if self.deduper.since is None:
+                self.deduper.since = start_time
+            self.deduper.prune(start_time - self.grace)
+        for checkpoint in self.state["streams"].values():
+            if checkpoint.get("seeded") is not None and checkpoint["seeded"] < (start_time - self.grace) * 1000:
+                del checkpoint["seeded"]
+        self.flush()
+
+    def commit_window(self):
+        if self.state["window_end"] is not None:
+            self.state["window_start"] = self.state["window_end"]
+        self.state["window_end"] = None
+        self.clear_tokens()
+        for checkpoint in self.state["streams"].values():
+            checkpoint.pop("until", None)
+        if self.idle_after is not None and self.state["window_start"] is not None:
+            #nothing that old is re-read, even with the grace overlap
+            cutoff = (self.state["window_start"] - max(self.idle_after, self.grace)) * 1000
+            for stream_name in [stream_name for stream_name, checkpoint in self.state["streams"].items()
+                    if checkpoint["timestamp"] < cutoff]:
+                del self.state["streams"][stream_name]
+        self.flush()
+
+    def maybe_flush(self):
+        if self.dirty >= self.flush_events or (self.dirty > 0
+                and time.time() - self.flushed_at >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self.before_flush is not None:
+            self.before_flush()
+        try:
+            if self.deduper is not None and self.deduper.dirty:
+                self.deduper.save(self.path + ".dedup")
+            atomic_write(self.path, json.dumps(self.state))
+        except OSError as e:
+            print ("EXCEPTION: could not write checkpoints", self.path, ":", e)
+            return False
+        self.dirty = 0
+        self.flushed_at = time.time()
+        return True
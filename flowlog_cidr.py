@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import ipaddress
+
+CLASS_INTERNAL = "internal"
+CLASS_PEERED = "peered"
+CLASS_AWS = "aws"
+CLASS_INTERNET = "internet"
+INTERNAL_CIDRS = "10.0.0.0/8"
+EGRESS_CLASSES = "aws,internet"
+CLASSIFY_CACHE_SIZE = 65536
+#CloudWatch limits filterPattern to 1024 characters
+MAX_FILTER_PATTERN = 1024
+MAX_WILDCARDS_PER_CIDR = 16
+FLOW_PATTERN_FIELDS = ["version", "account_id", "interface_id", "srcaddr", "dstaddr",
+    "srcport", "dstport", "protocol", "packets", "bytes", "start", "end", "action", "log_status"]
+
+#binary trie over address bits, lookup returns the value of the longest
+#matching prefix in at most prefix-length steps
+class PrefixTrie:
+    def __init__(self, bits):
+        self.bits = bits
+        #node: [child for bit 0, child for bit 1, value]
+        self.root = [None, None, None]
+
+    def insert(self, network, value):
+        node = self.root
+        addr = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (addr >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    def lookup(self, addr):
+        node = self.root
+        best = None
+        shift = self.bits - 1
+        while node is not None:
+            if node[2] is not None:
+                best = node[2]
+            if shift < 0:
+                break
+            node = node[(addr >> shift) & 1]
+            shift -= 1
+        return best
+
+def split_cidrs(value):
+    return [cidr.strip() for cidr in (value or "").split(",") if cidr.strip()]
+
+#octet aligned wildcards for an IPv4 network, e.g. 172.16.0.0/12 ->
+#172.16.*.* ... 172.31.*.*; None when it would take too many
+def ipv4_wildcards(network):
+    octets = (network.prefixlen + 7) // 8
+    if octets == 0:
+        return None
+    subnets = [network]
+    if network.prefixlen != octets * 8:
+        if 2 ** (octets * 8 - network.prefixlen) > MAX_WILDCARDS_PER_CIDR:
+            return None
+        subnets = list(network.subnets(new_prefix=octets * 8))
+    return [".".join(str(subnet.network_address).split(".")[:octets] + ["*"] * (4 - octets))
+        for subnet in subnets]
+
+#tags addresses as internal/peered/aws/internet; a flow is egress when its
+#source is internal and its destination class is one of egress_classes
+class CidrClassifier:
+    def __init__(self, internal=(), peered=(), aws=(), egress_classes=EGRESS_CLASSES.split(","),
+            cache_size=CLASSIFY_CACHE_SIZE):
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.networks = {CLASS_INTERNAL: [], CLASS_PEERED: [], CLASS_AWS: []}
+        self.egress_classes = set(egress_classes)
+        self.cache_size = cache_size
+        self.cache = {}
+        #on equal prefixes the class added last wins
+        for cidr in aws:
+            self.add(cidr, CLASS_AWS)
+        for cidr in peered:
+            self.add(cidr, CLASS_PEERED)
+        for cidr in internal:
+            self.add(cidr, CLASS_INTERNAL)
+
+    def add(self, cidr, cidr_class):
+        network = ipaddress.ip_network(cidr, strict=False)
+        self.tries[network.version].insert(network, cidr_class)
+        self.networks[cidr_class].append(network)
+        self.cache.clear()
+
+    def classify(self, ip):
+        cidr_class = self.cache.get(ip)
+        if cidr_class is not None:
+            return cidr_class
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            #"-" in NODATA/SKIPDATA records
+            return None
+        cidr_class = self.tries[addr.version].lookup(int(addr)) or CLASS_INTERNET
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[ip] = cidr_class
+        return cidr_class
+
+    def is_egress(self, srcaddr, dstaddr):
+        return (self.classify(srcaddr) == CLASS_INTERNAL
+            and self.classify(dstaddr) in self.egress_classes)
+
+    #"srcaddr = a || srcaddr = b" for the internal IPv4 ranges, None when
+    #they cannot all be written as wildcards (IPv6, very short prefixes)
+    def src_condition(self):
+        wildcards = []
+        for network in self.networks[CLASS_INTERNAL]:
+            if network.version != 4 or ipv4_wildcards(network) is None:
+                return None
+            wildcards.extend(ipv4_wildcards(network))
+        if not wildcards:
+            return None
+        return " || ".join("srcaddr = " + wildcard for wildcard in wildcards)
+
+    #excludes the non-egress IPv4 ranges that can be written as wildcards,
+    #whatever is left is dropped client-side
+    def dst_condition(self):
+        wildcards = []
+        for cidr_class in (CLASS_INTERNAL, CLASS_PEERED, CLASS_AWS):
+            if cidr_class in self.egress_classes:
+                continue
+            for network in self.networks[cidr_class]:
+                if network.version == 4 and ipv4_wildcards(network) is not None:
+                    wildcards.extend(ipv4_wildcards(network))
+        if not wildcards:
+            return None
+        return " && ".join("dstaddr != " + wildcard for wildcard in wildcards)
+
+    #server-side filter pattern for the same selection, as far as the
+    #CloudWatch space-delimited syntax and length limit allow
+    def filter_pattern(self):
+        conditions = [self.src_condition(), self.dst_condition()]
+        while True:
+            fields = list(FLOW_PATTERN_FIELDS)
+            if conditions[0] is not None:
+                fields[3] = conditions[0]
+            if conditions[1] is not None:
+                fields[4] = conditions[1]
+            pattern = "[" + ", ".join(fields) + "]"
+            if len(pattern) <= MAX_FILTER_PATTERN:
+                return pattern
+            if conditions[1] is not None:
+                conditions[1] = None
+            else:
+                conditions[0] = None
+
+    def stats(self):
+        return dict((cidr_class, len(networks)) for cidr_class, networks in self.networks.items())
+
+#IPv4/IPv6 CIDR blocks associated with a VPC
+def vpc_cidrs(ec2_client, vpc_id):
+    cidrs = []
+    vpcs = ec2_client.describe_vpcs(VpcIds=[vpc_id])
+    for vpc in vpcs.get("Vpcs", []):
+        for assoc in vpc.get("CidrBlockAssociationSet", []):
+            if assoc.get("CidrBlockState", {}).get("State", "associated") == "associated":
+                cidrs.append(assoc["CidrBlock"])
+        for assoc in vpc.get("Ipv6CidrBlockAssociationSet", []):
+            if assoc.get("Ipv6CidrBlockState", {}).get("State", "associated") == "associated":
+                cidrs.append(assoc["Ipv6CidrBlock"])
+        if not cidrs and "CidrBlock" in vpc:
+            cidrs.append(vpc["CidrBlock"])
+    return cidrs
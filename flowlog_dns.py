@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import socket
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+DNS_MODE = "inline"
+DNS_TIMEOUT = 1.0
+DNS_WORKERS = 16
+DNS_CACHE_SIZE = 65536
+DNS_CACHE_TTL = 3600
+DNS_NEGATIVE_TTL = 300
+DNS_NX = "NX"
+DNS_PENDING = "PENDING"
+
+def gethostbyaddr_resolver(ip):
+    return socket.gethostbyaddr(ip)[0]
+
+#reverse DNS on a worker pool with a bounded LRU+TTL cache, NXDOMAIN/timeouts
+#are cached too; resolve_func is pluggable so tests can use a local stub
+class ReverseDnsResolver:
+    def __init__(self, resolve_func=gethostbyaddr_resolver, mode=DNS_MODE,
+            timeout=DNS_TIMEOUT, workers=DNS_WORKERS, cache_size=DNS_CACHE_SIZE,
+            cache_ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+        self.resolve_func = resolve_func
+        self.mode = mode
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.cache = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.lookups = 0
+
+    def cache_get(self, ip):
+        entry = self.cache.get(ip)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self.cache[ip]
+            return None
+        self.cache.move_to_end(ip)
+        return entry[0]
+
+    def cache_put(self, ip, name, ttl):
+        self.cache[ip] = (name, time.time() + ttl)
+        self.cache.move_to_end(ip)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def do_lookup(self, ip):
+        self.lookups += 1
+        try:
+            name = self.resolve_func(ip)
+        except Exception:
+            name = None
+        with self.lock:
+            if name:
+                self.cache_put(ip, name, self.cache_ttl)
+            else:
+                self.cache_put(ip, DNS_NX, self.negative_ttl)
+            self.inflight.pop(ip, None)
+        return name or DNS_NX
+
+    #returns the in-flight future for ip, starting one if needed
+    def submit(self, ip):
+        with self.lock:
+            name = self.cache_get(ip)
+            if name is not None:
+                self.hits += 1
+                return name, None
+            self.misses += 1
+            future = self.inflight.get(ip)
+            if future is None:
+                future = self.executor.submit(self.do_lookup, ip)
+                self.inflight[ip] = future
+        return None, future
+
+    def resolve(self, ip):
+        if self.mode == "off":
+            return DNS_NX
+        name, future = self.submit(ip)
+        if name is not None:
+            return name
+        #async mode: answer later events from cache once the lookup lands
+        if self.mode == "async":
+            return DNS_PENDING
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            with self.lock:
+                if ip not in self.cache:
+                    self.cache_put(ip, DNS_NX, self.negative_ttl)
+            return DNS_NX
+
+    def prefetch(self, ips):
+        if self.mode == "off":
+            return
+        for ip in ips:
+            self.submit(ip)
+
+    #(ip, name, expires) entries, e.g. from a snapshot; expired ones are skipped
+    def warm(self, entries):
+        now = time.time()
+        with self.lock:
+            for ip, name, expires in entries:
+                if expires > now and ip not in self.cache:
+                    self.cache_put(ip, name, expires - now)
+
+    def cache_items(self):
+        with self.lock:
+            return [(ip, entry[0], entry[1]) for ip, entry in self.cache.items()]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "timeouts": self.timeouts,
+            "lookups": self.lookups,
+            "cache_size": len(self.cache),
+            "inflight": len(self.inflight),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
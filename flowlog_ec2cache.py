@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from collections import OrderedDict
+import flowlog_metrics as metrics
+
+EC2_CACHE_TTL = 300
+EC2_NEGATIVE_CACHE_SIZE = 4096
+EC2_NEGATIVE_CACHE_TTL = 60
+
+def instance_details(instance):
+    details = {
+        "instance_id": instance.get("InstanceId", "NX_INSTANCE"),
+        "instance_type": instance.get("InstanceType", "NX_INSTANCE"),
+        "instance_name": "NX_INSTANCE",
+        "subnet_id": instance.get("SubnetId", "NX_INSTANCE"),
+        "ami_id": instance.get("ImageId", "NX_INSTANCE"),
+        "vpc_id": instance.get("VpcId", "NONE"),
+    }
+    #we can have multiple tags, say, Name, Owner etc.
+    for tag in instance.get("Tags", []):
+        if tag.get("Key") == "Name":
+            details["instance_name"] = tag.get("Value", "NX_INSTANCE")
+    return details
+
+def index_instance(instance, by_ip, by_eni):
+    details = instance_details(instance)
+    if "PrivateIpAddress" in instance:
+        by_ip[instance["PrivateIpAddress"]] = details
+    #instances can have several ENIs, each with secondary private IPs
+    for eni in instance.get("NetworkInterfaces", []):
+        if "NetworkInterfaceId" in eni:
+            by_eni[eni["NetworkInterfaceId"]] = details
+        for addr in eni.get("PrivateIpAddresses", []):
+            if "PrivateIpAddress" in addr:
+                by_ip[addr["PrivateIpAddress"]] = details
+    return details
+
+#private IP/ENI -> instance metadata, loaded in bulk per VPC and refreshed on TTL;
+#lock guards the index swap and the negative cache against the refresher thread
+class Ec2InstanceIndex:
+    def __init__(self, ec2_client, vpc_id=None, ttl=EC2_CACHE_TTL,
+            negative_size=EC2_NEGATIVE_CACHE_SIZE, negative_ttl=EC2_NEGATIVE_CACHE_TTL):
+        self.ec2_client = ec2_client
+        self.vpc_id = vpc_id
+        self.ttl = ttl
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self.by_ip = {}
+        self.by_eni = {}
+        self.negative = OrderedDict()
+        self.loaded_at = 0
+        self.refresher = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.api_calls = 0
+        self.refreshes = 0
+
+    def describe_kwargs(self):
+        if self.vpc_id:
+            return {"Filters": [{"Name": "vpc-id", "Values": [self.vpc_id]}]}
+        return {}
+
+    def refresh(self):
+        by_ip = {}
+        by_eni = {}
+        try:
+            paginator = self.ec2_client.get_paginator("describe_instances")
+            for page in paginator.paginate(**self.describe_kwargs()):
+                self.api_calls += 1
+                metrics.inc("api_calls", api="describe_instances")
+                for reservation in page.get("Reservations", []):
+                    for instance in reservation.get("Instances", []):
+                        index_instance(instance, by_ip, by_eni)
+        except Exception as e:
+            metrics.api_error("describe_instances", e)
+            #keep serving the previous (stale) index, retry on next cycle
+            print ("EXCEPTION: Could not load EC2 inventory for VPC", self.vpc_id, ":", e)
+            return False
+        with self.lock:
+            self.by_ip = by_ip
+            self.by_eni = by_eni
+            self.negative.clear()
+            self.loaded_at = time.time()
+        self.refreshes += 1
+        print ("INFO: EC2 index loaded, private IPs:", len(by_ip), "ENIs:", len(by_eni))
+        return True
+
+    #background: keep serving the current (e.g. snapshot) inventory while
+    #a thread reloads it; the first load always blocks
+    def refresh_if_stale(self, background=False):
+        if time.time() - self.loaded_at < self.ttl:
+            return False
+        if not background or not self.by_ip:
+            return self.refresh()
+        if self.refresher is None or not self.refresher.is_alive():
+            self.refresher = threading.Thread(target=self.refresh, daemon=True)
+            self.refresher.start()
+        return False
+
+    #inventory restored from a snapshot taken at loaded_at
+    def warm(self, by_ip, by_eni, loaded_at):
+        with self.lock:
+            self.by_ip = by_ip
+            self.by_eni = by_eni
+            self.loaded_at = loaded_at
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.by_ip), dict(self.by_eni), self.loaded_at
+
+    def is_negative(self, key):
+        with self.lock:
+            expires = self.negative.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.negative[key]
+                return False
+            self.negative.move_to_end(key)
+            return True
+
+    def add_negative(self, key):
+        with self.lock:
+            self.negative[key] = time.time() + self.negative_ttl
+            self.negative.move_to_end(key)
+            while len(self.negative) > self.negative_size:
+                self.negative.popitem(last=False)
+
+    #instances launched after the last bulk load are fetched one by one
+    def lookup_single(self, src_ip):
+        self.api_calls += 1
+        metrics.inc("api_calls", api="describe_instances")
+        try:
+            ec2_details = self.ec2_client.describe_instances(
+                Filters=[{"Name": "private-ip-address", "Values": [src_ip,]}])
+        except Exception as e:
+            metrics.api_error("describe_instances", e)
+            print ("EXCEPTION: Could not call API describe_instances() with ", src_ip)
+            return None
+        details = None
+        by_ip = {}
+        by_eni = {}
+        for reservation in ec2_details.get("Reservations", []):
+            for instance in reservation.get("Instances", []):
+                details = index_instance(instance, by_ip, by_eni)
+        #added to whichever index is current, a refresh may have swapped it
+        with self.lock:
+            self.by_ip.update(by_ip)
+            self.by_eni.update(by_eni)
+        return by_ip.get(src_ip, details)
+
+    def lookup(self, src_ip, interface_id=None):
+        details = self.by_ip.get(src_ip)
+        if details is None and interface_id is not None:
+            details = self.by_eni.get(interface_id)
+        if details is not None:
+            self.hits += 1
+            return details
+        self.misses += 1
+        if self.is_negative(src_ip):
+            self.negative_hits += 1
+            return None
+        details = self.lookup_single(src_ip)
+        if details is None:
+            self.add_negative(src_ip)
+        return details
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "api_calls": self.api_calls,
+            "refreshes": self.refreshes,
+            "indexed_ips": len(self.by_ip),
+            "negative_size": len(self.negative),
+        }
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import flowlog_metrics as metrics
+
+FETCH_CONCURRENCY = 8
+FETCH_QUEUE_SIZE = 16
+QUEUE_PUT_TIMEOUT = 1.0
+
+#per-stream progress, errors stay with the stream that raised them
+class StreamProgress:
+    def __init__(self, stream_name):
+        self.stream_name = stream_name
+        self.pages = 0
+        self.events = 0
+        self.error = None
+        self.done = False
+        self.next_token = None
+
+    def __repr__(self):
+        return "StreamProgress(%s pages=%d events=%d done=%s error=%s)" % (
+            self.stream_name, self.pages, self.events, self.done, self.error)
+
+def put_until_stopped(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def page_stream(logs_client, base_kwargs, extra_kwargs, progress, out_queue, stop):
+    filterevents_kwargs = dict(base_kwargs)
+    filterevents_kwargs.update(extra_kwargs)
+    filterevents_kwargs['logStreamNames'] = [progress.stream_name]
+    try:
+        log_pages = logs_client.get_paginator('filter_log_events')
+        page_iterator = iter(log_pages.paginate(**filterevents_kwargs))
+        while True:
+            with metrics.timer("api_seconds", api="filter_log_events"):
+                logpage = next(page_iterator, None)
+            if logpage is None or stop.is_set():
+                return
+            metrics.inc("api_calls", api="filter_log_events")
+            progress.pages += 1
+            if len(logpage['events']) < 1:
+                continue
+            progress.events += len(logpage['events'])
+            #blocks while the consumer is behind, keeps memory flat
+            page = (progress.stream_name, logpage['events'], logpage.get('nextToken'))
+            if not put_until_stopped(out_queue, page, stop):
+                return
+    except Exception as e:
+        progress.error = e
+        metrics.api_error("filter_log_events", e)
+        print ("EXCEPTION: filter_log_events Paginator:", progress.stream_name, e)
+    finally:
+        progress.done = True
+        put_until_stopped(out_queue, None, stop)
+
+#generator, pages many streams at once and yields events as they arrive,
+#order is kept within a stream but not across streams. stream_kwargs adds
+#per-stream arguments (startTime, PaginationConfig), on_page is called with
+#a page's events before they are yielded, on_page_done once every event of
+#a page has been consumed
+def fetch_streams(logs_client, base_kwargs, stream_names, progress=None,
+        concurrency=FETCH_CONCURRENCY, queue_size=FETCH_QUEUE_SIZE,
+        stream_kwargs=None, on_page_done=None, on_page=None):
+    if progress is None:
+        progress = {}
+    if stream_kwargs is None:
+        stream_kwargs = {}
+    if len(stream_names) < 1:
+        return
+    out_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    for stream_name in stream_names:
+        progress[stream_name] = StreamProgress(stream_name)
+        executor.submit(page_stream, logs_client, base_kwargs,
+            stream_kwargs.get(stream_name, {}), progress[stream_name], out_queue, stop)
+    remaining = len(stream_names)
+    try:
+        while remaining > 0:
+            page = out_queue.get()
+            if page is None:
+                remaining -= 1
+                continue
+            stream_name, events, next_token = page
+            if on_page is not None:
+                on_page(events)
+            for event in events:
+                yield event
+            progress[stream_name].next_token = next_token
+            if on_page_done is not None:
+                on_page_done(stream_name, next_token)
+    finally:
+        #consumer may stop early, release workers blocked on the queue
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
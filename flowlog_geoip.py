@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import json
+import mmap
+import time
+import array
+import struct
+import bisect
+import ipaddress
+from collections import OrderedDict
+
+GEOIP_INDEX = "geoip.idx"
+GEOIP_CACHE_SIZE = 16384
+GEOIP_CHECK_INTERVAL = 60
+GEOIP_NX = "NX"
+#ASN of the ranges listed in AWS ip-ranges.json
+AWS_ASN = 16509
+INDEX_MAGIC = b"FLGEOIP1"
+#magic, IPv4 ranges, IPv6 ranges, bytes of the JSON record table
+INDEX_HEADER = struct.Struct("<8sIII")
+
+def open_source(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+#AWS ip-ranges.json, tagged with service and region instead of an AS name
+def read_aws_ranges(fh):
+    ranges = json.load(fh)
+    for prefix in ranges.get("prefixes", []) + ranges.get("ipv6_prefixes", []):
+        network = ipaddress.ip_network(prefix.get("ip_prefix") or prefix.get("ipv6_prefix"))
+        yield (network.network_address, network.broadcast_address,
+            (GEOIP_NX, AWS_ASN, "AWS-%s-%s" % (prefix.get("service"), prefix.get("region"))))
+
+#range_start, range_end, AS_number, country_code, AS_description per line,
+#tab or comma separated (the iptoasn.com ip2asn-combined.tsv layout)
+def read_asn_ranges(fh):
+    for line in fh:
+        if not line.strip() or line.startswith("#"):
+            continue
+        columns = line.rstrip("\n").split("\t" if "\t" in line else ",", 4)
+        if len(columns) < 5:
+            continue
+        try:
+            start = ipaddress.ip_address(columns[0].strip())
+            end = ipaddress.ip_address(columns[1].strip())
+            asn = int(columns[2])
+        except ValueError:
+            #header line
+            continue
+        #"Not routed" ranges
+        if asn == 0:
+            continue
+        yield start, end, (columns[3].strip() or GEOIP_NX, asn, columns[4].strip().strip('"'))
+
+def read_ranges(path):
+    with open_source(path) as fh:
+        if path.endswith(".json") or path.endswith(".json.gz"):
+            return list(read_aws_ranges(fh))
+        return list(read_asn_ranges(fh))
+
+#an inner record without country or ASN (e.g. an AWS prefix) takes them
+#from the range around it
+def inherit(record, outer):
+    country, asn, description = record
+    if country == GEOIP_NX:
+        country = outer[0]
+    if not asn:
+        asn = outer[1]
+    return country, asn, description
+
+#nested/overlapping ranges of (country, asn, description) split into
+#disjoint ones, the innermost wins for the fields it has
+def flatten(ranges):
+    flat = []
+    def emit(start, end, record):
+        if start > end:
+            return
+        if flat and flat[-1][1] + 1 == start and flat[-1][2] == record:
+            flat[-1] = (flat[-1][0], end, record)
+        else:
+            flat.append((start, end, record))
+    ranges.sort(key=lambda r: (r[0], -r[1]))
+    stack = []
+    position = 0
+    for start, end, record in ranges:
+        while stack and stack[-1][0] < start:
+            open_end, open_record = stack.pop()
+            emit(position, open_end, open_record)
+            position = max(position, open_end + 1)
+        if stack:
+            emit(position, start - 1, stack[-1][1])
+            record = inherit(record, stack[-1][1])
+        position = max(position, start)
+        stack.append((end, record))
+    while stack:
+        open_end, open_record = stack.pop()
+        emit(position, open_end, open_record)
+        position = max(position, open_end + 1)
+    return flat
+
+#sources (ASN/country dumps, ip-ranges.json) -> one sorted binary index:
+#header, IPv4 starts/ends/record ids as uint32 arrays, IPv6 starts/ends as
+#16 byte big-endian keys plus uint32 record ids, then the record table
+def compile_index(sources, index_path):
+    records = {}
+    ranges = {4: [], 6: []}
+    for path in sources:
+        for start, end, record in read_ranges(path):
+            ranges[start.version].append((int(start), int(end), record))
+    #record ids after flattening, inherited fields make new records
+    ipv4 = [(start, end, records.setdefault(record, len(records)))
+        for start, end, record in flatten(ranges[4])]
+    ipv6 = [(start, end, records.setdefault(record, len(records)))
+        for start, end, record in flatten(ranges[6])]
+    table = json.dumps(sorted(records, key=records.get)).encode()
+    #backfill workers may compile the same index concurrently
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    with open(tmp_path, "wb") as fh:
+        fh.write(INDEX_HEADER.pack(INDEX_MAGIC, len(ipv4), len(ipv6), len(table)))
+        for column in range(3):
+            array.array("I", [r[column] for r in ipv4]).tofile(fh)
+        for column in range(2):
+            fh.write(b"".join(r[column].to_bytes(16, "big") for r in ipv6))
+        array.array("I", [r[2] for r in ipv6]).tofile(fh)
+        fh.write(table)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, index_path)
+    return len(ipv4) + len(ipv6)
+
+#16 byte big-endian keys in a buffer, as a sequence bisect can search
+class Ipv6Keys:
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view) // 16
+
+    def __getitem__(self, i):
+        return int.from_bytes(self.view[i * 16:i * 16 + 16], "big")
+
+#compiled index mapped read-only, searched in place without loading it
+class RangeIndex:
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n4, n6, table_size = INDEX_HEADER.unpack_from(self.mm)
+        if magic != INDEX_MAGIC:
+            raise ValueError("%s is not a compiled GeoIP index" % path)
+        view = memoryview(self.mm)
+        offset = INDEX_HEADER.size
+        self.views = []
+        def take(size):
+            nonlocal offset
+            part = view[offset:offset + size]
+            offset += size
+            self.views.append(part)
+            return part
+        self.v4_starts = take(n4 * 4).cast("I")
+        self.v4_ends = take(n4 * 4).cast("I")
+        self.v4_records = take(n4 * 4).cast("I")
+        self.v6_starts = Ipv6Keys(take(n6 * 16))
+        self.v6_ends = Ipv6Keys(take(n6 * 16))
+        self.v6_records = take(n6 * 4).cast("I")
+        self.views.extend([self.v4_starts, self.v4_ends, self.v4_records, self.v6_records])
+        self.records = [tuple(record) for record in json.loads(bytes(take(table_size)))]
+        self.views.append(view)
+        self.size = n4 + n6
+
+    def lookup(self, ip):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if addr.version == 4:
+            starts, ends, record_ids = self.v4_starts, self.v4_ends, self.v4_records
+        else:
+            starts, ends, record_ids = self.v6_starts, self.v6_ends, self.v6_records
+        key = int(addr)
+        i = bisect.bisect_right(starts, key) - 1
+        if i < 0 or ends[i] < key:
+            return None
+        return self.records[record_ids[i]]
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.mm.close()
+        self.fh.close()
+
+#dstaddr -> (country, asn, as_org) from local range files; the sources are
+#compiled to index_path when newer than it and reloaded without a restart
+class GeoIpLookup:
+    def __init__(self, sources, index_path=GEOIP_INDEX, cache_size=GEOIP_CACHE_SIZE,
+            check_interval=GEOIP_CHECK_INTERVAL):
+        self.sources = sources
+        self.index_path = index_path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.cache = OrderedDict()
+        self.index = None
+        self.loaded_mtime = None
+        self.checked_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.maybe_reload()
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def maybe_reload(self):
+        self.checked_at = time.time()
+        try:
+            source_mtimes = [self.mtime(path) for path in self.sources]
+            index_mtime = self.mtime(self.index_path)
+            newest = max([mtime for mtime in source_mtimes if mtime is not None], default=None)
+            if newest is not None and (index_mtime is None or newest > index_mtime):
+                count = compile_index([path for path in self.sources if self.mtime(path)],
+                    self.index_path)
+                print ("INFO: GeoIP index compiled,", count, "ranges:", self.index_path)
+                index_mtime = self.mtime(self.index_path)
+            if index_mtime is None or index_mtime == self.loaded_mtime:
+                return False
+            index = RangeIndex(self.index_path)
+        except (OSError, ValueError) as e:
+            #keep serving the loaded index
+            print ("EXCEPTION: Could not load GeoIP index", self.index_path, ":", e)
+            return False
+        old_index = self.index
+        self.index = index
+        self.loaded_mtime = index_mtime
+        self.cache.clear()
+        self.reloads += 1
+        if old_index is not None:
+            old_index.close()
+        return True
+
+    def lookup(self, ip):
+        if time.time() - self.checked_at >= self.check_interval:
+            self.maybe_reload()
+        record = self.cache.get(ip)
+        if record is not None:
+            self.hits += 1
+            self.cache.move_to_end(ip)
+            return record
+        self.misses += 1
+        record = None
+        if self.index is not None:
+            record = self.index.lookup(ip)
+        if record is None:
+            record = (GEOIP_NX, 0, GEOIP_NX)
+        self.cache[ip] = record
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return record
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "ranges": self.index.size if self.index is not None else 0,
+        }
+
+#compile ahead of time: flowlog_geoip.py <index> <source> [<source> ...]
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print ("usage: flowlog_geoip.py <index> <source> [<source> ...]", file=sys.stderr)
+        sys.exit(-1)
+    print ("INFO: compiled", compile_index(sys.argv[2:], sys.argv[1]), "ranges into", sys.argv[1])
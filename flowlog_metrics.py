@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PREFIX = "flowlog_"
+THROTTLE_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded",
+    "TooManyRequestsException", "RequestThrottled")
+METRICS_PORT = 9108
+HISTOGRAM_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+#all functions return right away while metrics are off
+enabled = False
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+collectors = []
+
+def label_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    if not enabled:
+        return
+    inc_key(label_key(name, labels), value)
+
+def inc_key(key, value=1):
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    if not enabled:
+        return
+    gauges[label_key(name, labels)] = value
+
+def observe(name, seconds, **labels):
+    if not enabled:
+        return
+    observe_key(label_key(name, labels), seconds)
+
+def observe_key(key, seconds):
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(HISTOGRAM_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+class Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = NullTimer()
+
+def timer(name, **labels):
+    if not enabled:
+        return NULL_TIMER
+    return Timer(name, labels)
+
+#per-event counter/timer with the label key built once, timers are only
+#meant for code running on a single thread
+class Counter:
+    def __init__(self, name, **labels):
+        self.key = label_key(name, labels)
+
+    def inc(self, value=1):
+        if enabled:
+            inc_key(self.key, value)
+
+class StageTimer:
+    def __init__(self, name, **labels):
+        self.key = label_key(name, labels)
+        self.starts = []
+
+    def __enter__(self):
+        if enabled:
+            self.starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        if enabled and self.starts:
+            observe_key(self.key, time.perf_counter() - self.starts.pop())
+        return False
+
+def is_throttle(e):
+    response = getattr(e, "response", None) or {}
+    return response.get("Error", {}).get("Code") in THROTTLE_CODES
+
+def api_error(api, e):
+    if not enabled:
+        return
+    inc("api_errors", api=api)
+    if is_throttle(e):
+        inc("api_throttles", api=api)
+
+#collector() returns [(name, labels, value)], read as gauges at export time
+def register_collector(collector):
+    collectors.append(collector)
+
+def format_labels(labels, extra=None):
+    pairs = list(labels)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+#Prometheus text exposition format
+def render():
+    lines = []
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in histograms.items())
+    gauge_items = sorted(gauges.items())
+    for collector in collectors:
+        try:
+            for name, labels, value in collector():
+                gauge_items.append((label_key(name, labels), value))
+        except Exception as e:
+            print ("EXCEPTION: metrics collector failed:", e)
+    typed = set()
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            lines.append("# TYPE %s%s_total counter" % (METRICS_PREFIX, name))
+            typed.add(name)
+        lines.append("%s%s_total%s %s" % (METRICS_PREFIX, name, format_labels(labels), value))
+    for (name, labels), value in gauge_items:
+        if name not in typed:
+            lines.append("# TYPE %s%s gauge" % (METRICS_PREFIX, name))
+            typed.add(name)
+        lines.append("%s%s%s %s" % (METRICS_PREFIX, name, format_labels(labels), value))
+    for (name, labels), (buckets, total, count) in histogram_items:
+        if name not in typed:
+            lines.append("# TYPE %s%s histogram" % (METRICS_PREFIX, name))
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append("%s%s_bucket%s %d" % (METRICS_PREFIX, name,
+                format_labels(labels, ("le", bound)), cumulative))
+        lines.append("%s%s_bucket%s %d" % (METRICS_PREFIX, name,
+            format_labels(labels, ("le", "+Inf")), count))
+        lines.append("%s%s_sum%s %f" % (METRICS_PREFIX, name, format_labels(labels), total))
+        lines.append("%s%s_count%s %d" % (METRICS_PREFIX, name, format_labels(labels), count))
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port=METRICS_PORT, addr=""):
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print ("INFO: serving metrics on port", server.server_address[1])
+    return server
+
+#node_exporter textfile collector style dump
+def write_textfile(path):
+    from flowlog_checkpoint import atomic_write
+    try:
+        atomic_write(path, render())
+    except OSError as e:
+        print ("EXCEPTION: could not write metrics to", path, ":", e)
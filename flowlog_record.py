@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+
+OUTPUT_BATCH_SIZE = 500
+#VPC flow log v2 fields, named like the JSON keys they are emitted as
+FLOW_FIELDS = ("flow_log_version", "aws_account_id", "nw_interface_id",
+    "srcaddr", "dstaddr", "srcport", "dstport", "protocol", "packets",
+    "bytes", "estart_time", "eend_time", "nw_acl_action", "flowlog_status")
+TIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
+TIME_CACHE_SIZE = 4096
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        #NODATA/SKIPDATA records carry "-"
+        return None
+
+#one flow log line, split once with the numeric fields as ints
+class FlowRecord:
+    __slots__ = FLOW_FIELDS
+
+    def __init__(self, flow_fields):
+        (self.flow_log_version, self.aws_account_id, self.nw_interface_id,
+            self.srcaddr, self.dstaddr) = flow_fields[:5]
+        try:
+            (self.srcport, self.dstport, self.protocol, self.packets, self.bytes,
+                self.estart_time, self.eend_time) = map(int, flow_fields[5:12])
+        except ValueError:
+            (self.srcport, self.dstport, self.protocol, self.packets, self.bytes,
+                self.estart_time, self.eend_time) = map(to_int, flow_fields[5:12])
+        self.nw_acl_action = flow_fields[12]
+        self.flowlog_status = flow_fields[13]
+
+    def values(self):
+        return (self.flow_log_version, self.aws_account_id, self.nw_interface_id,
+            self.srcaddr, self.dstaddr, self.srcport, self.dstport, self.protocol,
+            self.packets, self.bytes, self.estart_time, self.eend_time,
+            self.nw_acl_action, self.flowlog_status)
+
+    def __repr__(self):
+        return "FlowRecord(%s)" % " ".join(str(value) for value in self.values())
+
+#returns None for short lines, and for non-egress lines when egress_filter
+#is given, before any int conversion is done
+def parse_flow(message, egress_filter=None):
+    flow_fields = message.split(' ')
+    if len(flow_fields) < 14:
+        return None
+    if egress_filter is not None and not egress_filter(flow_fields):
+        return None
+    return FlowRecord(flow_fields)
+
+#flows in a window share few distinct start/end seconds
+time_cache = {}
+
+def format_time(epoch):
+    formatted = time_cache.get(epoch)
+    if formatted is None:
+        if epoch is None:
+            return "NONE"
+        if len(time_cache) >= TIME_CACHE_SIZE:
+            time_cache.clear()
+        formatted = time_cache[epoch] = time.strftime(TIME_FORMAT, time.localtime(epoch))
+    return formatted
+
+#NDJSON lines collected and written batch_size at a time
+class NdjsonWriter:
+    def __init__(self, fh=None, batch_size=OUTPUT_BATCH_SIZE):
+        self.fh = fh
+        self.batch_size = batch_size
+        self.lines = []
+        self.encode = json.JSONEncoder().encode
+
+    def write(self, doc):
+        self.lines.append(self.encode(doc))
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        fh = self.fh or sys.stdout
+        self.lines.append("")
+        fh.write("\n".join(self.lines))
+        fh.flush()
+        self.lines = []
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import time
+
+ROLLUP_KEYS = "instance_id,dstaddr,dstport,protocol,nw_acl_action"
+ROLLUP_WINDOW = 300
+ROLLUP_LATENESS = 600
+ROLLUP_MAX_KEYS = 100000
+
+#missing or "-" counters add nothing to a total
+def int_or_zero(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+#tumbling windows by flow start time, {window_start: state} in windows;
+#the latest start seen is the watermark, windows ending more than lateness
+#before it are complete and handed to flush_window(window_start, partial)
+class TumblingWindows:
+    def __init__(self, window, lateness):
+        self.window = window
+        self.lateness = lateness
+        self.windows = {}
+        self.watermark = 0
+
+    def window_start(self, start):
+        return start - (start % self.window)
+
+    #window_start's window was flushed already
+    def is_closed(self, window_start):
+        return window_start + self.window + self.lateness <= self.watermark
+
+    def advance(self, start):
+        if start > self.watermark:
+            self.watermark = start
+            self.close_windows(self.watermark)
+
+    #windows ending more than lateness before now are complete
+    def close_windows(self, now):
+        for window_start in sorted(self.windows):
+            if window_start + self.window + self.lateness > now:
+                break
+            self.flush_window(window_start)
+
+    def tick(self):
+        self.close_windows(int(time.time()))
+
+    #the next flows may come from anywhere in time (e.g. the next backfill
+    #file), so the watermark starts over
+    def flush_all(self):
+        for window_start in sorted(self.windows):
+            self.flush_window(window_start, partial=True)
+        self.watermark = 0
+
+#tumbling-window totals of packets/bytes/flows per key, windows are emitted
+#once closed; the oldest window is emitted early when max_keys is reached
+class FlowRollup(TumblingWindows):
+    def __init__(self, emit, key_fields=ROLLUP_KEYS.split(","), window=ROLLUP_WINDOW,
+            lateness=ROLLUP_LATENESS, max_keys=ROLLUP_MAX_KEYS):
+        TumblingWindows.__init__(self, window, lateness)
+        self.emit = emit
+        self.key_fields = key_fields
+        self.max_keys = max_keys
+        self.total_keys = 0
+        self.flows_in = 0
+        self.docs_out = 0
+
+    def add(self, flow):
+        start = int_or_zero(flow.get("estart_time"))
+        window_start = self.window_start(start)
+        key = tuple(flow.get(field, "NONE") for field in self.key_fields)
+        aggs = self.windows.get(window_start)
+        if aggs is None:
+            aggs = self.windows[window_start] = {}
+        agg = aggs.get(key)
+        if agg is None:
+            agg = aggs[key] = [0, 0, 0, start, start]
+            self.total_keys += 1
+        agg[0] += int_or_zero(flow.get("packets"))
+        agg[1] += int_or_zero(flow.get("bytes"))
+        agg[2] += 1
+        if start < agg[3]:
+            agg[3] = start
+        if start > agg[4]:
+            agg[4] = start
+        self.flows_in += 1
+        self.advance(start)
+        while self.total_keys > self.max_keys:
+            self.flush_window(min(self.windows), partial=True)
+
+    def flush_window(self, window_start, partial=False):
+        aggs = self.windows.pop(window_start)
+        self.total_keys -= len(aggs)
+        for key, agg in aggs.items():
+            doc = {"record_type": "rollup",
+                "window_start": window_start,
+                "window_end": window_start + self.window,
+                "partial": partial}
+            doc.update(zip(self.key_fields, key))
+            doc["packets"] = agg[0]
+            doc["bytes"] = agg[1]
+            doc["flows"] = agg[2]
+            doc["first_seen"] = agg[3]
+            doc["last_seen"] = agg[4]
+            self.emit(doc)
+            self.docs_out += 1
+
+    def stats(self):
+        return {
+            "flows_in": self.flows_in,
+            "docs_out": self.docs_out,
+            "open_windows": len(self.windows),
+            "open_keys": self.total_keys,
+        }
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import random
+import threading
+from botocore.exceptions import ConnectionError, HTTPClientError
+import flowlog_metrics as metrics
+
+#calls per second (0: unlimited), bursts of twice that
+API_RATES = {"describe_log_streams": 5, "filter_log_events": 10, "describe_instances": 20,
+    "get_log_events": 25, "describe_vpcs": 0}
+API_MAX_RETRIES = 8
+API_BACKOFF_BASE = 0.2
+API_BACKOFF_MAX = 20.0
+#on a throttle the rate drops to THROTTLE_DECREASE of itself (not below
+#MIN_RATE_FACTOR of the configured one), every success adds RATE_INCREASE back
+THROTTLE_DECREASE = 0.7
+MIN_RATE_FACTOR = 0.1
+RATE_INCREASE = 0.02
+#server side errors retried like throttles, without lowering the rate
+TRANSIENT_CODES = ("ServiceUnavailable", "ServiceUnavailableException", "InternalFailure",
+    "InternalError", "InternalServerError", "RequestTimeout", "RequestTimeoutException")
+#request/response token names of the paginated APIs
+PAGE_TOKENS = {"describe_log_streams": "nextToken", "filter_log_events": "nextToken",
+    "describe_instances": "NextToken"}
+
+#5xx answers and connection/read failures, botocore's own retries are off
+def is_transient(e):
+    if isinstance(e, (ConnectionError, HTTPClientError)):
+        return True
+    response = getattr(e, "response", None) or {}
+    return (response.get("Error", {}).get("Code") in TRANSIENT_CODES
+        or response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500)
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, 2 * rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    #blocks until a call may be made, returns the seconds waited
+    def acquire(self):
+        waited = 0.0
+        while self.max_rate > 0:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate * THROTTLE_DECREASE)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE)
+
+class ApiCallStats:
+    def __init__(self):
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.waited = 0.0
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+#one per process, shared by every client: rate limits each API with an
+#adaptive token bucket, retries throttles and transient errors with jittered
+#exponential backoff and lets concurrent identical requests share one call
+class CallScheduler:
+    def __init__(self, rates=API_RATES, max_retries=API_MAX_RETRIES,
+            backoff_base=API_BACKOFF_BASE, backoff_max=API_BACKOFF_MAX):
+        self.rates = dict(rates)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.buckets = {}
+        self.api_stats = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, api):
+        with self.lock:
+            if api not in self.buckets:
+                self.buckets[api] = TokenBucket(self.rates.get(api, 0))
+                self.api_stats[api] = ApiCallStats()
+            return self.buckets[api]
+
+    def call_with_retries(self, api, func, kwargs):
+        bucket = self.bucket(api)
+        stats = self.api_stats[api]
+        attempt = 0
+        while True:
+            stats.waited += bucket.acquire()
+            stats.calls += 1
+            try:
+                result = func(**kwargs)
+            except Exception as e:
+                throttled = metrics.is_throttle(e)
+                if not (throttled or is_transient(e)) or attempt >= self.max_retries:
+                    stats.errors += 1
+                    raise
+                stats.retries += 1
+                metrics.inc("api_retries", api=api)
+                if throttled:
+                    stats.throttles += 1
+                    bucket.throttled()
+                #full jitter keeps throttled callers from retrying in step
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+                attempt += 1
+                continue
+            bucket.succeeded()
+            return result
+
+    def call(self, api, func, **kwargs):
+        key = (api, json.dumps(kwargs, sort_keys=True, default=str))
+        self.bucket(api)
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Flight()
+            else:
+                self.api_stats[api].coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self.call_with_retries(api, func, kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self):
+        with self.lock:
+            return dict((api, {"calls": stats.calls, "throttles": stats.throttles,
+                "retries": stats.retries, "errors": stats.errors, "coalesced": stats.coalesced,
+                "waited": round(stats.waited, 3), "rate": round(self.buckets[api].rate, 3)})
+                for api, stats in self.api_stats.items())
+
+#paginates through the scheduler, one scheduled call per page;
+#PaginationConfig StartingToken is a raw page token
+class ScheduledPaginator:
+    def __init__(self, scheduler, client, api):
+        self.scheduler = scheduler
+        self.client = client
+        self.api = api
+
+    def paginate(self, **kwargs):
+        config = kwargs.pop("PaginationConfig", None) or {}
+        token_name = PAGE_TOKENS[self.api]
+        token = config.get("StartingToken")
+        while True:
+            request = dict(kwargs)
+            if token:
+                request[token_name] = token
+            page = self.scheduler.call(self.api, getattr(self.client, self.api), **request)
+            yield page
+            token = page.get(token_name)
+            if not token:
+                return
+
+#boto3 client whose API_RATES calls (and their paginators) go through
+#scheduler, anything else is passed straight to the client
+class ScheduledClient:
+    def __init__(self, client, scheduler):
+        self.client = client
+        self.scheduler = scheduler
+
+    def get_paginator(self, name):
+        if name in PAGE_TOKENS:
+            return ScheduledPaginator(self.scheduler, self.client, name)
+        return self.client.get_paginator(name)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in API_RATES:
+            return attr
+        def scheduled(**kwargs):
+            return self.scheduler.call(name, attr, **kwargs)
+        return scheduled
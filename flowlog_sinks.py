@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import gzip
+import json
+import time
+import queue
+import socket
+import threading
+import flowlog_metrics as metrics
+
+OUTPUT_SINK = "stdout"
+OUTPUT_BUFFER_SIZE = 10000
+OUTPUT_FLUSH_INTERVAL = 1.0
+OUTPUT_RETRY_MAX = 30
+SENSU_HOST = "127.0.0.1"
+SENSU_PORT = 3030
+SENSU_PROTO = "tcp"
+SENSU_CHECK_NAME = "vpc_egress_flows"
+SENSU_TIMEOUT = 5
+SENSU_MAX_PAYLOAD = 1048576
+SENSU_UDP_MAX_PAYLOAD = 60000
+OUTPUT_FILE_DIR = "/flowlog/output"
+OUTPUT_FILE_PREFIX = "flows"
+OUTPUT_FILE_MAX_BYTES = 100 * 1048576
+OUTPUT_FILE_KEEP = 10
+
+class StdoutSink:
+    def __init__(self, fh=None):
+        self.fh = fh
+
+    def write_lines(self, lines):
+        fh = self.fh or sys.stdout
+        fh.write("\n".join(lines) + "\n")
+        fh.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+#NDJSON files rotated by size, gzip compressed, the oldest beyond keep removed
+class RotatingFileSink:
+    def __init__(self, directory=OUTPUT_FILE_DIR, prefix=OUTPUT_FILE_PREFIX,
+            max_bytes=OUTPUT_FILE_MAX_BYTES, keep=OUTPUT_FILE_KEEP, compress=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.compress = compress
+        self.fh = None
+        self.raw = None
+        self.path = None
+        self.written = 0
+        self.sequence = 0
+
+    def open_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sequence += 1
+        name = "%s-%s-%04d.ndjson" % (self.prefix, time.strftime('%Y%m%d-%H%M%S'), self.sequence)
+        if self.compress:
+            name += ".gz"
+        self.path = os.path.join(self.directory, name)
+        #the raw file is kept for fsync, gzip does not close it
+        self.raw = open(self.path, "wb")
+        if self.compress:
+            self.fh = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw, mode="wb"))
+        else:
+            self.fh = io.TextIOWrapper(self.raw)
+        self.written = 0
+
+    def files(self):
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if name.startswith(self.prefix + "-") and ".ndjson" in name)
+
+    def rotate(self):
+        self.close()
+        for path in self.files()[:-self.keep or None]:
+            os.remove(path)
+        self.open_file()
+
+    def write_lines(self, lines):
+        if self.fh is None:
+            self.open_file()
+        data = "\n".join(lines) + "\n"
+        self.fh.write(data)
+        self.written += len(data)
+        if self.written >= self.max_bytes:
+            self.rotate()
+
+    #gzip sync flush, everything written so far can be decompressed from disk
+    def flush(self):
+        if self.fh is None:
+            return
+        self.fh.flush()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            if not self.raw.closed:
+                self.raw.close()
+            self.fh = None
+            self.raw = None
+
+#Sensu client socket, one check result per batch with the NDJSON lines as
+#output; TCP connection kept open and reopened when Sensu drops it
+class SensuSink:
+    def __init__(self, host=SENSU_HOST, port=SENSU_PORT, proto=SENSU_PROTO,
+            check_name=SENSU_CHECK_NAME, handlers=None, timeout=SENSU_TIMEOUT,
+            max_payload=SENSU_MAX_PAYLOAD):
+        self.host = host
+        self.port = port
+        self.proto = proto
+        self.check_name = check_name
+        self.handlers = handlers or []
+        self.timeout = timeout
+        self.max_payload = max_payload
+        if proto == "udp":
+            self.max_payload = min(max_payload, SENSU_UDP_MAX_PAYLOAD)
+        self.sock = None
+
+    def connect(self):
+        if self.proto == "udp":
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect((self.host, self.port))
+        else:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.settimeout(self.timeout)
+
+    def payload(self, lines):
+        check = {"name": self.check_name, "type": "metric", "status": 0,
+            "output": "\n".join(lines)}
+        if self.handlers:
+            check["handlers"] = self.handlers
+        return json.dumps(check).encode()
+
+    #splits a batch so every check result stays under max_payload
+    def chunks(self, lines):
+        chunk = []
+        size = 0
+        for line in lines:
+            #quotes and backslashes are escaped inside output
+            line_size = len(line) + line.count('"') + line.count('\\') + 2
+            if chunk and size + line_size + 256 > self.max_payload:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += line_size
+        if chunk:
+            yield chunk
+
+    def send(self, data):
+        if self.sock is None:
+            self.connect()
+        if self.proto == "udp":
+            self.sock.send(data)
+            return
+        self.sock.sendall(data)
+        #the client socket answers "ok" for every check result it accepts
+        reply = self.sock.recv(64)
+        if not reply.startswith(b"ok"):
+            raise OSError("sensu client socket replied %r" % reply)
+
+    def write_lines(self, lines):
+        for chunk in self.chunks(lines):
+            data = self.payload(chunk)
+            try:
+                self.send(data)
+            except OSError:
+                #stale persistent connection, retry once on a new one
+                self.close()
+                self.send(data)
+
+    #TCP results are acknowledged one by one, nothing is held back
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+class FlushRequest:
+    def __init__(self):
+        self.done = threading.Event()
+
+#bounded buffer between enrichment and a sink, written by a background
+#thread every flush_size lines or flush_interval seconds; write() blocks
+#while the buffer is full so a slow sink holds back the fetch stage
+class BufferedOutput:
+    def __init__(self, sink, buffer_size=OUTPUT_BUFFER_SIZE, flush_size=500,
+            flush_interval=OUTPUT_FLUSH_INTERVAL):
+        self.sink = sink
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.encode = json.JSONEncoder().encode
+        self.blocked = 0
+        self.errors = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, doc):
+        if self.queue.full():
+            self.blocked += 1
+            metrics.inc("output_blocked")
+        self.queue.put(self.encode(doc))
+
+    def write_batch(self, lines):
+        retry = 1
+        while True:
+            try:
+                self.sink.write_lines(lines)
+                self.batches += 1
+                metrics.inc("output_batches")
+                metrics.inc("output_lines", len(lines))
+                return
+            except OSError as e:
+                self.errors += 1
+                metrics.inc("output_errors")
+                print ("EXCEPTION: output sink failed, retrying in %ds:" % retry, e)
+                time.sleep(retry)
+                retry = min(retry * 2, OUTPUT_RETRY_MAX)
+
+    #makes the batches written so far durable in the sink
+    def sync(self):
+        retry = 1
+        while True:
+            try:
+                self.sink.flush()
+                return
+            except OSError as e:
+                self.errors += 1
+                metrics.inc("output_errors")
+                print ("EXCEPTION: output sink flush failed, retrying in %ds:" % retry, e)
+                time.sleep(retry)
+                retry = min(retry * 2, OUTPUT_RETRY_MAX)
+
+    def run(self):
+        lines = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                item = None
+            if isinstance(item, FlushRequest):
+                if lines:
+                    self.write_batch(lines)
+                    lines = []
+                self.sync()
+                item.done.set()
+                continue
+            if item is not None:
+                lines.append(item)
+            if len(lines) >= self.flush_size or (lines and time.time() >= deadline):
+                self.write_batch(lines)
+                lines = []
+            if time.time() >= deadline:
+                deadline = time.time() + self.flush_interval
+
+    #returns once everything written so far has reached the sink
+    def flush(self):
+        request = FlushRequest()
+        self.queue.put(request)
+        request.done.wait()
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+    def stats(self):
+        return {"buffered": self.queue.qsize(), "blocked": self.blocked,
+            "batches": self.batches, "errors": self.errors}
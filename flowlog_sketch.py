@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import heapq
+import hashlib
+from flowlog_rollup import TumblingWindows, int_or_zero
+
+SKETCH_TOPK = 0
+SKETCH_KEYS = "instance_id,dstaddr,dstport"
+SKETCH_NEW_KEYS = "dstaddr"
+SKETCH_WINDOW = 300
+SKETCH_LATENESS = 600
+SKETCH_COUNTERS = 1000
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+SKETCH_SEEN_CAPACITY = 1000000
+SKETCH_SEEN_ERROR = 0.01
+SKETCH_MAX_ALERTS = 100
+SKETCH_STATE_FILE = "sketch_seen.bin"
+#hot keys skip hashing, the caches are cleared when they reach this size
+SKETCH_KEY_CACHE_SIZE = 65536
+
+#two 64 bit hashes, row/probe i uses h1 + i * h2
+def key_hashes(key):
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+class CountMinSketch:
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for i in range(depth)]
+
+    #one column per row, shared by every sketch of the same width/depth
+    def cells(self, hashes):
+        h1, h2 = hashes
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, cells, value):
+        for row, cell in zip(self.rows, cells):
+            row[cell] += value
+
+    #never below the true total, above it by at most ~e/width of the stream
+    def estimate(self, cells):
+        return min(row[cell] for row, cell in zip(self.rows, cells))
+
+#weighted Space-Saving: at most capacity counters, a new key takes over the
+#smallest one and inherits its count as error
+class SpaceSaving:
+    def __init__(self, capacity=SKETCH_COUNTERS):
+        self.capacity = capacity
+        self.counters = {}
+        #(count, key), entries go stale as counts grow and are fixed on pop
+        self.heap = []
+
+    def add(self, key, value):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += value
+            return
+        error = 0
+        if len(self.counters) >= self.capacity:
+            while True:
+                count, smallest = heapq.heappop(self.heap)
+                if self.counters[smallest][0] == count:
+                    break
+                heapq.heappush(self.heap, (self.counters[smallest][0], smallest))
+            error = count
+            del self.counters[smallest]
+        self.counters[key] = [error + value, error]
+        heapq.heappush(self.heap, (error + value, key))
+
+    #[(key, count, error)] largest first
+    def top(self, k):
+        return [(key, counter[0], counter[1]) for key, counter in
+            heapq.nlargest(k, self.counters.items(), key=lambda item: item[1][0])]
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.probes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, hashes):
+        h1, h2 = hashes
+        new = False
+        for i in range(self.probes):
+            bit = (h1 + i * h2) % self.size
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                self.bits[bit >> 3] |= 1 << (bit & 7)
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, hashes):
+        h1, h2 = hashes
+        for i in range(self.probes):
+            bit = (h1 + i * h2) % self.size
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+#destinations seen before, in two Bloom generations: when the current one
+#holds capacity keys it becomes the previous one, so memory stays bounded
+#and destinations unseen for two generations count as new again
+class SeenFilter:
+    def __init__(self, capacity=SKETCH_SEEN_CAPACITY, error_rate=SKETCH_SEEN_ERROR):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.rotations = 0
+
+    #True if key was not seen yet
+    def add(self, key):
+        hashes = key_hashes(key)
+        seen = hashes in self.previous
+        if not self.current.add(hashes):
+            return False
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotations += 1
+        return not seen
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as fh:
+            data = fh.read()
+        size = len(self.current.bits)
+        if len(data) != 2 * size + 8:
+            print ("INFO: ignoring", path, "written with other SKETCH_SEEN settings")
+            return False
+        self.current.bits[:] = data[8:8 + size]
+        self.previous.bits[:] = data[8 + size:]
+        self.current.count = int.from_bytes(data[:8], "little")
+        return True
+
+    def save(self, path):
+        data = self.current.count.to_bytes(8, "little") + bytes(self.current.bits) + bytes(self.previous.bits)
+        with open(path + ".tmp", "wb") as fh:
+            fh.write(data)
+        os.replace(path + ".tmp", path)
+
+class WindowSketch:
+    def __init__(self, counters, width, depth):
+        self.bytes = CountMinSketch(width, depth)
+        self.packets = CountMinSketch(width, depth)
+        self.talkers = SpaceSaving(counters)
+        self.alerts = []
+        self.suppressed = 0
+        self.flows = 0
+        self.total_bytes = 0
+        self.total_packets = 0
+
+#per tumbling window (by flow start time) the top talkers by bytes and the
+#destinations never seen before, in memory independent of the flow volume
+class FlowSketch(TumblingWindows):
+    def __init__(self, emit, topk=10, key_fields=SKETCH_KEYS.split(","),
+            new_key_fields=SKETCH_NEW_KEYS.split(","), window=SKETCH_WINDOW,
+            lateness=SKETCH_LATENESS, counters=SKETCH_COUNTERS, width=SKETCH_WIDTH,
+            depth=SKETCH_DEPTH, seen_capacity=SKETCH_SEEN_CAPACITY,
+            seen_error=SKETCH_SEEN_ERROR, max_alerts=SKETCH_MAX_ALERTS, state_path=None):
+        TumblingWindows.__init__(self, window, lateness)
+        self.emit = emit
+        self.topk = topk
+        self.key_fields = key_fields
+        self.new_key_fields = new_key_fields
+        self.alert_fields = key_fields + [field for field in new_key_fields if field not in key_fields]
+        self.counters = max(counters, topk)
+        self.width = width
+        self.depth = depth
+        self.max_alerts = max_alerts
+        self.state_path = state_path
+        self.seen = SeenFilter(seen_capacity, seen_error)
+        #open windows beyond this are emitted early, memory stays fixed
+        self.max_windows = lateness // window + 2
+        self.key_cells = {}
+        self.known = set()
+        #with no saved filter every destination is new, learn for a window first
+        self.learn_until = None
+        self.warm = False
+        if state_path is not None:
+            try:
+                self.warm = self.seen.load(state_path)
+            except OSError as e:
+                print ("EXCEPTION: could not read", state_path, ":", e)
+        self.dirty = False
+        self.flows_in = 0
+        self.late = 0
+        self.alerts_out = 0
+        self.docs_out = 0
+
+    def add(self, flow):
+        start = int_or_zero(flow.get("estart_time"))
+        window_start = self.window_start(start)
+        self.flows_in += 1
+        sketch = self.windows.get(window_start)
+        if sketch is None:
+            #its window was emitted already, only the seen filter learns it
+            if self.is_closed(window_start):
+                self.late += 1
+                self.is_new(flow)
+                return
+            sketch = self.windows[window_start] = WindowSketch(self.counters, self.width, self.depth)
+        packets = int_or_zero(flow.get("packets"))
+        nbytes = int_or_zero(flow.get("bytes"))
+        key = "\x1f".join(str(flow.get(field, "NONE")) for field in self.key_fields)
+        cells = self.key_cells.get(key)
+        if cells is None:
+            if len(self.key_cells) >= SKETCH_KEY_CACHE_SIZE:
+                self.key_cells.clear()
+            cells = self.key_cells[key] = sketch.bytes.cells(key_hashes(key))
+        sketch.bytes.add(cells, nbytes)
+        sketch.packets.add(cells, packets)
+        sketch.talkers.add(key, nbytes)
+        sketch.flows += 1
+        sketch.total_bytes += nbytes
+        sketch.total_packets += packets
+        if self.learn_until is None:
+            self.learn_until = 0 if self.warm else window_start + self.window
+        if self.is_new(flow) and start >= self.learn_until:
+            if len(sketch.alerts) < self.max_alerts:
+                sketch.alerts.append(dict((field, flow.get(field, "NONE"))
+                    for field in self.alert_fields))
+                sketch.alerts[-1]["first_seen"] = start
+            else:
+                sketch.suppressed += 1
+        self.advance(start)
+        while len(self.windows) > self.max_windows:
+            self.flush_window(min(self.windows), partial=True)
+
+    def is_new(self, flow):
+        new_key = "\x1f".join(str(flow.get(field, "NONE")) for field in self.new_key_fields)
+        if new_key in self.known:
+            return False
+        if len(self.known) >= SKETCH_KEY_CACHE_SIZE:
+            self.known.clear()
+        self.known.add(new_key)
+        self.dirty = True
+        return self.seen.add(new_key)
+
+    def flush_window(self, window_start, partial=False):
+        sketch = self.windows.pop(window_start)
+        header = {"window_start": window_start, "window_end": window_start + self.window,
+            "partial": partial}
+        for rank, (key, count, error) in enumerate(sketch.talkers.top(self.topk), 1):
+            cells = sketch.bytes.cells(key_hashes(key))
+            doc = {"record_type": "top_talker", "rank": rank}
+            doc.update(header)
+            doc.update(zip(self.key_fields, key.split("\x1f")))
+            doc["bytes"] = min(count, sketch.bytes.estimate(cells))
+            doc["bytes_error"] = error
+            doc["packets"] = sketch.packets.estimate(cells)
+            self.emit(doc)
+            self.docs_out += 1
+        for alert in sketch.alerts:
+            doc = {"record_type": "new_destination"}
+            doc.update(header)
+            doc.update(alert)
+            self.emit(doc)
+            self.alerts_out += 1
+        doc = {"record_type": "sketch_summary", "flows": sketch.flows,
+            "bytes": sketch.total_bytes, "packets": sketch.total_packets,
+            "new_destinations": len(sketch.alerts) + sketch.suppressed,
+            "alerts_suppressed": sketch.suppressed}
+        doc.update(header)
+        self.emit(doc)
+        self.docs_out += 1
+
+    def save(self):
+        if self.state_path is None or not self.dirty:
+            return
+        try:
+            self.seen.save(self.state_path)
+            self.dirty = False
+        except OSError as e:
+            print ("EXCEPTION: could not write", self.state_path, ":", e)
+
+    def tick(self):
+        TumblingWindows.tick(self)
+        self.save()
+
+    def flush_all(self):
+        TumblingWindows.flush_all(self)
+        self.save()
+
+    def stats(self):
+        return {
+            "flows_in": self.flows_in,
+            "docs_out": self.docs_out,
+            "alerts_out": self.alerts_out,
+            "late": self.late,
+            "open_windows": len(self.windows),
+            "seen": self.seen.current.count,
+            "seen_rotations": self.seen.rotations,
+        }
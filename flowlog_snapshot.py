@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import sqlite3
+
+SNAPSHOT_FILE = "enrichment.db"
+SNAPSHOT_INTERVAL = 300
+#an older EC2 inventory is not worth serving even while it is refreshed
+SNAPSHOT_MAX_AGE = 86400
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value REAL) WITHOUT ROWID;
+CREATE TABLE instances (id INTEGER PRIMARY KEY, details TEXT);
+CREATE TABLE ec2_keys (key TEXT PRIMARY KEY, instance INTEGER, eni INTEGER) WITHOUT ROWID;
+CREATE TABLE dns (ip TEXT PRIMARY KEY, name TEXT, expires REAL) WITHOUT ROWID;
+"""
+
+#EC2 inventory and reverse DNS cache in one sqlite file, rewritten whole
+#(temp file + rename) every interval so a restart starts warm
+class EnrichmentSnapshot:
+    def __init__(self, path, interval=SNAPSHOT_INTERVAL, max_age=SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.saved_at = time.time()
+        self.saves = 0
+        self.save_seconds = 0.0
+        self.loaded_ec2 = 0
+        self.loaded_dns = 0
+
+    def connect(self):
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            return sqlite3.connect("file:%s?mode=ro" % self.path, uri=True)
+        except sqlite3.Error as e:
+            print ("EXCEPTION: could not open enrichment snapshot", self.path, ":", e)
+            return None
+
+    #fills an empty Ec2InstanceIndex, returns False if there is no usable snapshot
+    def load_ec2(self, ec2_index):
+        db = self.connect()
+        if db is None:
+            return False
+        try:
+            row = db.execute("SELECT value FROM meta WHERE key = 'ec2_loaded_at'").fetchone()
+            if row is None or time.time() - row[0] > self.max_age:
+                return False
+            instances = dict((instance_id, json.loads(details))
+                for instance_id, details in db.execute("SELECT id, details FROM instances"))
+            by_ip = {}
+            by_eni = {}
+            for key, instance_id, eni in db.execute("SELECT key, instance, eni FROM ec2_keys"):
+                (by_eni if eni else by_ip)[key] = instances[instance_id]
+        except (sqlite3.Error, ValueError, KeyError) as e:
+            print ("EXCEPTION: could not read enrichment snapshot", self.path, ":", e)
+            return False
+        finally:
+            db.close()
+        ec2_index.warm(by_ip, by_eni, row[0])
+        self.loaded_ec2 = len(by_ip)
+        print ("INFO: EC2 index warm from snapshot, private IPs:", len(by_ip),
+            "age:", int(time.time() - row[0]))
+        return True
+
+    #PTR names (and NX) that have not expired yet
+    def load_dns(self, dns_resolver):
+        db = self.connect()
+        if db is None:
+            return 0
+        try:
+            entries = db.execute("SELECT ip, name, expires FROM dns WHERE expires > ? "
+                "ORDER BY expires DESC LIMIT ?", (time.time(), dns_resolver.cache_size)).fetchall()
+        except sqlite3.Error as e:
+            print ("EXCEPTION: could not read enrichment snapshot", self.path, ":", e)
+            return 0
+        finally:
+            db.close()
+        #oldest first so the LRU keeps the longest lived
+        dns_resolver.warm(reversed(entries))
+        self.loaded_dns = len(entries)
+        print ("INFO: DNS cache warm from snapshot, entries:", len(entries))
+        return len(entries)
+
+    def save(self, ec2_index, dns_resolver):
+        started = time.time()
+        by_ip, by_eni, loaded_at = ec2_index.snapshot()
+        instances = {}
+        keys = []
+        for eni, index in ((0, by_ip), (1, by_eni)):
+            for key, details in index.items():
+                instance_id = instances.setdefault(id(details), (len(instances), details))[0]
+                keys.append((key, instance_id, eni))
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            db = sqlite3.connect(tmp_path)
+            try:
+                db.executescript(SCHEMA)
+                if loaded_at:
+                    db.execute("INSERT INTO meta VALUES ('ec2_loaded_at', ?)", (loaded_at,))
+                db.executemany("INSERT INTO instances VALUES (?, ?)",
+                    ((instance_id, json.dumps(details)) for instance_id, details in instances.values()))
+                db.executemany("INSERT INTO ec2_keys VALUES (?, ?, ?)", keys)
+                db.executemany("INSERT INTO dns VALUES (?, ?, ?)",
+                    (entry for entry in dns_resolver.cache_items() if entry[2] > started))
+                db.commit()
+            finally:
+                db.close()
+            os.replace(tmp_path, self.path)
+        except (OSError, sqlite3.Error) as e:
+            print ("EXCEPTION: could not write enrichment snapshot", self.path, ":", e)
+            return False
+        self.saved_at = time.time()
+        self.saves += 1
+        self.save_seconds = round(self.saved_at - started, 3)
+        return True
+
+    def maybe_save(self, ec2_index, dns_resolver):
+        if time.time() - self.saved_at >= self.interval:
+            return self.save(ec2_index, dns_resolver)
+        return False
+
+    def stats(self):
+        return {
+            "loaded_ec2_ips": self.loaded_ec2,
+            "loaded_dns": self.loaded_dns,
+            "saves": self.saves,
+            "save_seconds": self.save_seconds,
+        }
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import time
+from botocore.exceptions import ClientError, PaginationError
+import flowlog_metrics as metrics
+
+#lastEventTimestamp is updated eventually, AWS says within about an hour
+STREAM_IDLE_GRACE = 3600
+STREAM_RETENTION = 7 * 86400
+
+#known LogStreams of a LogGroup, relisted newest first and only down to the
+#streams that are older than the window being read
+class StreamRegistry:
+    def __init__(self, log_grp_name, idle_grace=STREAM_IDLE_GRACE, retention=STREAM_RETENTION):
+        self.log_grp_name = log_grp_name
+        self.idle_grace = idle_grace
+        self.retention = retention
+        self.streams = {}
+        self.list_pages = 0
+        self.listed = 0
+        self.skipped = 0
+        self.active = 0
+
+    def cutoff_ms(self, window_start):
+        if not window_start:
+            return 0
+        return (int(window_start) - self.idle_grace) * 1000
+
+    def refresh(self, logs_client, window_start=0):
+        logstream_kwargs = {}
+        logstream_kwargs["logGroupName"] = self.log_grp_name
+        logstream_kwargs["orderBy"] = "LastEventTime"
+        logstream_kwargs["descending"] = True
+        cutoff = self.cutoff_ms(window_start)
+        listed = 0
+        paginator = logs_client.get_paginator('describe_log_streams')
+        try:
+            for logstream in paginator.paginate(**logstream_kwargs):
+                self.list_pages += 1
+                metrics.inc("api_calls", api="describe_log_streams")
+                older = False
+                for lstream in logstream["logStreams"]:
+                    listed += 1
+                    self.streams[lstream["logStreamName"]] = lstream
+                    if lstream.get("lastEventTimestamp", 0) < cutoff:
+                        older = True
+                #the rest of the group is idle since before the window
+                if older:
+                    break
+        except PaginationError as e:
+            print ("EXCEPTION: describe_log_streams Paginator:", e.kwargs['message'])
+            metrics.api_error("describe_log_streams", e)
+        except ClientError as e:
+            print ("EXCEPTION: describe_log_streams:", e)
+            metrics.api_error("describe_log_streams", e)
+        self.listed = listed
+        self.prune(cutoff)
+        return listed
+
+    #forget streams idle for longer than retention that the window no longer needs
+    def prune(self, window_cutoff=0):
+        cutoff = min((time.time() - self.retention) * 1000, window_cutoff)
+        for name in [name for name, lstream in self.streams.items()
+                if lstream.get("lastEventTimestamp", 0) < cutoff]:
+            del self.streams[name]
+
+    def all_streams(self):
+        return list(self.streams.values())
+
+    #streams that may have events at or after window_start
+    def active_streams(self, lstreams_list, window_start):
+        cutoff = self.cutoff_ms(window_start)
+        active = [lstream for lstream in lstreams_list
+            if lstream.get("lastEventTimestamp", 0) >= cutoff]
+        self.active = len(active)
+        self.skipped = len(lstreams_list) - len(active)
+        return active
+
+    #epoch seconds before/after which no stream can have events, None if unknown
+    def event_bounds(self, lstreams_list):
+        first = [lstream.get("firstEventTimestamp") for lstream in lstreams_list]
+        last = [lstream.get("lastEventTimestamp") for lstream in lstreams_list]
+        if not lstreams_list or None in first or None in last:
+            return None, None
+        return min(first) // 1000, max(last) // 1000 + self.idle_grace
+
+    def stats(self):
+        return {
+            "known": len(self.streams),
+            "listed": self.listed,
+            "list_pages": self.list_pages,
+            "active": self.active,
+            "skipped": self.skipped,
+        }
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import json
+from flowlog_checkpoint import atomic_write
+import flowlog_metrics as metrics
+
+TAIL_MIN_INTERVAL = 2.0
+TAIL_MAX_INTERVAL = 300.0
+TAIL_INITIAL_INTERVAL = 10.0
+TAIL_CONCURRENCY = 4
+TAIL_LIST_INTERVAL = 60
+TAIL_FLUSH_INTERVAL = 5
+TAIL_PAGE_LIMIT = 5000
+TAIL_STATE_FILE = "tail_cursors.json"
+#an empty poll stretches the interval by this much, events halve it
+TAIL_BACKOFF = 1.5
+
+#position of one LogStream: the get_log_events forward token of the last
+#page handed to enrichment, and when to poll it next
+class TailCursor:
+    def __init__(self, stream_name, token=None, start_time=0, interval=TAIL_INITIAL_INTERVAL):
+        self.stream_name = stream_name
+        self.token = token
+        self.start_time = start_time
+        self.interval = interval
+        self.next_poll = 0.0
+        self.busy = False
+        self.last_timestamp = None
+        self.caught_up = False
+        self.polls = 0
+        self.empty_polls = 0
+        self.events = 0
+
+    def request(self, log_grp_name, limit):
+        kwargs = {"logGroupName": log_grp_name, "logStreamName": self.stream_name,
+            "startFromHead": True, "limit": limit}
+        if self.token:
+            kwargs["nextToken"] = self.token
+        else:
+            kwargs["startTime"] = self.start_time * 1000
+        return kwargs
+
+#follows every active stream with its own cursor; streams with new events
+#are polled every few seconds, quiet ones back off up to max_interval
+class StreamTailer:
+    def __init__(self, log_grp_name, start_time=0, min_interval=TAIL_MIN_INTERVAL,
+            max_interval=TAIL_MAX_INTERVAL, page_limit=TAIL_PAGE_LIMIT):
+        self.log_grp_name = log_grp_name
+        self.start_time = start_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.page_limit = page_limit
+        self.cursors = {}
+        self.saved_tokens = {}
+        self.polls = 0
+        self.empty_polls = 0
+        self.errors = 0
+        self.events = 0
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, "r") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError) as e:
+            print ("EXCEPTION: could not read tail cursors", path, ":", e)
+            return False
+        self.saved_tokens = state.get("streams", {})
+        print ("INFO: loaded tail cursors for", len(self.saved_tokens), "LogStreams")
+        return True
+
+    def tokens(self):
+        tokens = dict(self.saved_tokens)
+        tokens.update((name, cursor.token) for name, cursor in self.cursors.items() if cursor.token)
+        return tokens
+
+    #only call once the events before every token have been flushed
+    def save(self, path):
+        try:
+            atomic_write(path, json.dumps({"streams": self.tokens()}))
+        except OSError as e:
+            print ("EXCEPTION: could not write tail cursors", path, ":", e)
+
+    #follows exactly stream_names from now on; handoffs are tokens passed
+    #on by the previous owner of a stream
+    def sync(self, stream_names, handoffs=None):
+        for stream_name in stream_names:
+            if stream_name in self.cursors:
+                continue
+            token = (handoffs or {}).get(stream_name) or self.saved_tokens.get(stream_name)
+            self.cursors[stream_name] = TailCursor(stream_name, token, self.start_time)
+        listed = set(stream_names)
+        for stream_name in [name for name in self.cursors if name not in listed]:
+            cursor = self.cursors.pop(stream_name)
+            if cursor.token:
+                self.saved_tokens[stream_name] = cursor.token
+
+    #true while a listed stream may still have events this worker has not read
+    def behind(self, lstream):
+        cursor = self.cursors.get(lstream["logStreamName"])
+        if cursor is None:
+            return lstream.get("lastEventTimestamp", 0) >= self.start_time * 1000
+        return not cursor.caught_up
+
+    #how far back LogStreams have to be listed for the cursors still behind
+    def list_from(self, now):
+        if not self.cursors:
+            return self.start_time
+        return min([now] + [cursor.last_timestamp // 1000 if cursor.last_timestamp else cursor.start_time
+            for cursor in self.cursors.values() if not cursor.caught_up])
+
+    def due(self, now):
+        return sorted((cursor for cursor in self.cursors.values()
+            if not cursor.busy and cursor.next_poll <= now), key=lambda cursor: cursor.next_poll)
+
+    def next_wakeup(self):
+        return min((cursor.next_poll for cursor in self.cursors.values() if not cursor.busy),
+            default=None)
+
+    #runs on a worker thread, returns (events, next token) or (None, error);
+    #the cursor is only moved by done() once the events are enriched
+    def poll(self, logs_client, cursor):
+        try:
+            response = logs_client.get_log_events(**cursor.request(self.log_grp_name, self.page_limit))
+        except Exception as e:
+            metrics.api_error("get_log_events", e)
+            print ("EXCEPTION: get_log_events:", cursor.stream_name, e)
+            return None, e
+        metrics.inc("api_calls", api="get_log_events")
+        return response.get("events", []), response.get("nextForwardToken")
+
+    def done(self, cursor, events, token, now):
+        cursor.busy = False
+        self.polls += 1
+        cursor.polls += 1
+        if events is None:
+            self.errors += 1
+            response = getattr(token, "response", None) or {}
+            if response.get("Error", {}).get("Code") == "InvalidParameterException":
+                #token no longer accepted, restart from the last event seen
+                cursor.token = None
+                if cursor.last_timestamp is not None:
+                    cursor.start_time = cursor.last_timestamp // 1000
+            cursor.interval = min(self.max_interval, max(self.min_interval, cursor.interval * 2))
+        elif events:
+            self.events += len(events)
+            cursor.events += len(events)
+            cursor.last_timestamp = events[-1]["timestamp"]
+            cursor.caught_up = False
+            cursor.token = token or cursor.token
+            cursor.interval = max(self.min_interval, cursor.interval / 2)
+            if len(events) >= self.page_limit:
+                #backlog, read on right away
+                cursor.interval = 0
+        elif token and token != cursor.token:
+            #empty page short of the end of the stream
+            cursor.token = token
+            cursor.interval = 0
+        else:
+            #the same token comes back at the end of the stream
+            self.empty_polls += 1
+            cursor.empty_polls += 1
+            cursor.caught_up = True
+            cursor.interval = min(self.max_interval, max(self.min_interval, cursor.interval * TAIL_BACKOFF))
+        cursor.next_poll = now + cursor.interval
+
+    def stats(self):
+        return {
+            "streams": len(self.cursors),
+            "hot": len([cursor for cursor in self.cursors.values()
+                if cursor.interval <= 2 * self.min_interval]),
+            "polls": self.polls,
+            "empty_polls": self.empty_polls,
+            "errors": self.errors,
+            "events": self.events,
+        }
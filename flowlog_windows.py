@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+
+WINDOW_MIN = 60
+WINDOW_MAX = 21600
+WINDOW_INITIAL = 300
+WINDOW_TARGET_EVENTS = 50000
+WINDOW_PARALLEL = 2
+WINDOW_SMOOTHING = 0.5
+#seconds each window re-reads before its start, for late ingested events
+WINDOW_GRACE = 0
+#events a window fetched ahead holds before its fetch waits for the consumer
+WINDOW_PREFETCH_EVENTS = 10000
+
+#splits [start, end) into windows expected to hold about target_events,
+#sized from the event density (events/sec, smoothed) of the windows done
+#so far; once caught up a cycle is shorter than one window and stays whole
+class WindowPlanner:
+    def __init__(self, min_window=WINDOW_MIN, max_window=WINDOW_MAX,
+            initial_window=WINDOW_INITIAL, target_events=WINDOW_TARGET_EVENTS,
+            smoothing=WINDOW_SMOOTHING):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.initial_window = initial_window
+        self.target_events = target_events
+        self.smoothing = smoothing
+        self.density = None
+        self.windows = 0
+        self.events = 0
+
+    def window_size(self):
+        if self.density is None:
+            return self.initial_window
+        if self.density <= 0:
+            return self.max_window
+        return int(min(max(self.target_events / self.density, self.min_window), self.max_window))
+
+    #first_event/last_event (epoch seconds) bound where events can be, the
+    #stretches outside them are not split
+    def next_end(self, start, end, first_event=None, last_event=None):
+        if last_event is not None and start >= last_event:
+            return end
+        if first_event is not None and start < first_event - self.min_window:
+            return min(end, first_event)
+        window_end = start + self.window_size()
+        #no tail window shorter than min_window
+        if end - window_end < self.min_window:
+            return end
+        return window_end
+
+    def observe(self, seconds, events):
+        self.windows += 1
+        self.events += events
+        if seconds <= 0:
+            return
+        density = events / seconds
+        if self.density is None:
+            self.density = density
+        else:
+            self.density = self.smoothing * density + (1 - self.smoothing) * self.density
+
+    def stats(self):
+        return {
+            "windows": self.windows,
+            "events": self.events,
+            "events_per_sec": round(self.density, 3) if self.density is not None else None,
+            "window_size": self.window_size(),
+        }
+
+#a window fetched on a background thread through a bounded queue: the fetch
+#blocks once max_events wait, so a long window is never held whole in memory
+class PrefetchedWindow:
+    DONE = object()
+
+    def __init__(self, max_events=WINDOW_PREFETCH_EVENTS):
+        self.queue = queue.Queue(maxsize=max(1, max_events))
+        self.progress = {}
+        self.future = None
+        self.closed = threading.Event()
+
+    #False once the consumer is gone, the fetch should stop
+    def put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def finish(self):
+        self.put(self.DONE)
+
+    def events(self):
+        while True:
+            item = self.queue.get()
+            if item is self.DONE:
+                break
+            yield item
+        #the fetch's own exception, if it failed
+        if self.future is not None:
+            self.future.result()
+
+    def close(self):
+        self.closed.set()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import bisect
+import fcntl
+import hashlib
+import threading
+from flowlog_checkpoint import atomic_write
+import flowlog_metrics as metrics
+
+WORKER_LEASE_TTL = 60
+WORKER_VNODES = 64
+LEASE_FILE = "leases.json"
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+#consistent hashing, a member joining or leaving only moves about 1/N of the keys
+class HashRing:
+    def __init__(self, members, vnodes=WORKER_VNODES):
+        self.members = sorted(members)
+        points = sorted((ring_hash("%s#%d" % (member, i)), member)
+            for member in self.members for i in range(vnodes))
+        self.hashes = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.owners[i]
+
+#leases and stream claims in one JSON file in a shared directory, every
+#change is made under an exclusive flock. Another backend only needs
+#heartbeat/members/claim/publish/release/leave with the same semantics
+class FileLeaseStore:
+    def __init__(self, directory, ttl=WORKER_LEASE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.path = os.path.join(directory, LEASE_FILE)
+        os.makedirs(directory, exist_ok=True)
+
+    def update(self, change):
+        with open(os.path.join(self.directory, LEASE_FILE + ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {"workers": {}, "claims": {}}
+                if os.path.isfile(self.path):
+                    with open(self.path, "r") as fh:
+                        state = json.load(fh)
+                result = change(state)
+                atomic_write(self.path, json.dumps(state))
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def alive(self, state, worker_id):
+        return state["workers"].get(worker_id, 0) >= time.time()
+
+    def heartbeat(self, worker_id):
+        def change(state):
+            state["workers"][worker_id] = time.time() + self.ttl
+            for expired in [worker for worker in state["workers"] if not self.alive(state, worker)]:
+                del state["workers"][expired]
+        self.update(change)
+
+    def members(self):
+        def change(state):
+            return sorted(worker for worker in state["workers"] if self.alive(state, worker))
+        return self.update(change)
+
+    #grants the keys that are free, already ours, or held by a dead worker;
+    #returns {key: checkpoint handed over by the previous owner or None}, for
+    #a dead owner the last one it published
+    def claim(self, worker_id, keys):
+        def change(state):
+            granted = {}
+            for key in keys:
+                claim = state["claims"].get(key)
+                if (claim is not None and claim.get("owner") not in (None, worker_id)
+                        and self.alive(state, claim["owner"])):
+                    continue
+                if claim is None or claim.get("owner") != worker_id:
+                    granted[key] = (claim or {}).get("checkpoint")
+                else:
+                    granted[key] = None
+                state["claims"][key] = {"owner": worker_id}
+                #kept for whoever takes over should this worker die first
+                if (claim or {}).get("checkpoint") is not None:
+                    state["claims"][key]["checkpoint"] = claim["checkpoint"]
+            return granted
+        return self.update(change)
+
+    #handoffs: {key: committed checkpoint}, stored with the claims still held
+    #so a takeover after a crash resumes from them
+    def publish(self, worker_id, handoffs):
+        def change(state):
+            for key, checkpoint in handoffs.items():
+                claim = state["claims"].get(key)
+                if claim is not None and claim.get("owner") == worker_id:
+                    claim["checkpoint"] = checkpoint
+        self.update(change)
+
+    #handoffs: {key: checkpoint for the next owner}
+    def release(self, worker_id, handoffs):
+        def change(state):
+            for key, checkpoint in handoffs.items():
+                claim = state["claims"].get(key)
+                if claim is not None and claim.get("owner") == worker_id:
+                    state["claims"][key] = {"owner": None, "checkpoint": checkpoint}
+        self.update(change)
+
+    def leave(self, worker_id, handoffs):
+        self.release(worker_id, handoffs)
+        def change(state):
+            state["workers"].pop(worker_id, None)
+        self.update(change)
+
+#splits stream keys between the live workers and holds this worker's claims;
+#a stream whose ring owner changed, or that is no longer listed, is only
+#released at a cycle boundary, the new owner skips it until then, so no
+#stream is read twice
+class StreamPartitioner:
+    def __init__(self, store, worker_id, vnodes=WORKER_VNODES):
+        self.store = store
+        self.worker_id = worker_id
+        self.vnodes = vnodes
+        self.owned = set()
+        self.members = []
+        self.stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.store.heartbeat(self.worker_id)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop.wait(max(1, self.store.ttl / 3)):
+            try:
+                self.store.heartbeat(self.worker_id)
+            except (OSError, ValueError) as e:
+                print ("EXCEPTION: worker lease heartbeat failed:", e)
+
+    #keys this worker may read this cycle, {key: handed over checkpoint or None};
+    #handoff(key) gives the checkpoint passed on for a key given up
+    def assign(self, keys, handoff):
+        members = self.store.members()
+        if self.worker_id not in members:
+            self.store.heartbeat(self.worker_id)
+            members = self.store.members()
+        if members != self.members:
+            print ("INFO: workers:", members)
+            self.members = members
+        ring = HashRing(members, self.vnodes)
+        mine = [key for key in keys if ring.owner(key) == self.worker_id]
+        #streams that moved to another worker or dropped out of the listing
+        listed = set(keys)
+        moved = [key for key in self.owned if key not in listed or ring.owner(key) != self.worker_id]
+        if moved:
+            self.store.release(self.worker_id, dict((key, handoff(key)) for key in moved))
+        granted = self.store.claim(self.worker_id, mine)
+        self.owned = set(granted)
+        metrics.set_gauge("worker_streams", len(self.owned))
+        metrics.set_gauge("worker_members", len(members))
+        return granted
+
+    #called once progress is committed, handoff(key) as for assign
+    def publish(self, handoff):
+        if self.owned:
+            self.store.publish(self.worker_id, dict((key, handoff(key)) for key in self.owned))
+
+    def close(self, handoff):
+        self.stop.set()
+        self.store.leave(self.worker_id, dict((key, handoff(key)) for key in self.owned))
+        self.owned = set()
+
+    def stats(self):
+        return {"worker_id": self.worker_id, "members": len(self.members), "owned": len(self.owned)}
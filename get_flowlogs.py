@@ -3,82 +3,355 @@
 import os
 import sys
 import time
-import socket 
-import json
+import atexit
+import signal
+import socket
 import boto3
-from botocore.exceptions import ClientError, PaginationError
+from botocore.config import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flowlog_ec2cache import (Ec2InstanceIndex, EC2_CACHE_TTL,
+    EC2_NEGATIVE_CACHE_SIZE, EC2_NEGATIVE_CACHE_TTL)
+from flowlog_dns import (ReverseDnsResolver, DNS_MODE, DNS_TIMEOUT,
+    DNS_WORKERS, DNS_CACHE_SIZE, DNS_CACHE_TTL, DNS_NEGATIVE_TTL)
+from flowlog_fetch import fetch_streams, FETCH_CONCURRENCY, FETCH_QUEUE_SIZE
+from flowlog_streams import StreamRegistry, STREAM_IDLE_GRACE, STREAM_RETENTION
+from flowlog_rollup import (FlowRollup, ROLLUP_KEYS, ROLLUP_WINDOW,
+    ROLLUP_LATENESS, ROLLUP_MAX_KEYS)
+import flowlog_metrics as metrics
+from flowlog_record import (FlowRecord, NdjsonWriter, parse_flow, format_time,
+    OUTPUT_BATCH_SIZE)
+from flowlog_sinks import (StdoutSink, SensuSink, RotatingFileSink, BufferedOutput,
+    OUTPUT_SINK, OUTPUT_BUFFER_SIZE, OUTPUT_FLUSH_INTERVAL, SENSU_HOST, SENSU_PORT,
+    SENSU_PROTO, SENSU_CHECK_NAME, OUTPUT_FILE_DIR, OUTPUT_FILE_PREFIX,
+    OUTPUT_FILE_MAX_BYTES, OUTPUT_FILE_KEEP)
+from flowlog_checkpoint import (CheckpointStore, EventDeduper, atomic_write, CHECKPOINT_FILE,
+    CHECKPOINT_FLUSH_EVENTS, CHECKPOINT_FLUSH_INTERVAL, DEDUP_BUCKET, DEDUP_CAPACITY, DEDUP_ERROR)
+from flowlog_geoip import (GeoIpLookup, GEOIP_INDEX, GEOIP_CACHE_SIZE,
+    GEOIP_CHECK_INTERVAL, GEOIP_NX)
+from flowlog_windows import (WindowPlanner, WINDOW_MIN, WINDOW_MAX, WINDOW_INITIAL,
+    WINDOW_TARGET_EVENTS, WINDOW_PARALLEL, WINDOW_GRACE, WINDOW_PREFETCH_EVENTS,
+    PrefetchedWindow)
+from flowlog_workers import (StreamPartitioner, FileLeaseStore, WORKER_LEASE_TTL,
+    WORKER_VNODES)
+from flowlog_scheduler import (CallScheduler, ScheduledClient, API_RATES,
+    API_MAX_RETRIES, API_BACKOFF_BASE, API_BACKOFF_MAX)
+from flowlog_tail import (StreamTailer, TAIL_MIN_INTERVAL, TAIL_MAX_INTERVAL,
+    TAIL_CONCURRENCY, TAIL_LIST_INTERVAL, TAIL_FLUSH_INTERVAL, TAIL_PAGE_LIMIT,
+    TAIL_STATE_FILE)
+from flowlog_snapshot import (EnrichmentSnapshot, SNAPSHOT_FILE, SNAPSHOT_INTERVAL,
+    SNAPSHOT_MAX_AGE)
+from flowlog_sketch import (FlowSketch, SKETCH_TOPK, SKETCH_KEYS, SKETCH_NEW_KEYS,
+    SKETCH_WINDOW, SKETCH_LATENESS, SKETCH_COUNTERS, SKETCH_WIDTH, SKETCH_DEPTH,
+    SKETCH_SEEN_CAPACITY, SKETCH_SEEN_ERROR, SKETCH_MAX_ALERTS, SKETCH_STATE_FILE)
+from flowlog_cidr import (CidrClassifier, split_cidrs, vpc_cidrs, INTERNAL_CIDRS,
+    EGRESS_CLASSES)
 
 MAX_LS_REQ_COUNT = 8
-#http://docs.aws.amazon.com/AmazonCloudWatch/latest/logs/FilterAndPatternSyntax.html
-EGRESS_FILTER = ('[version, account_id, interface_id, '
-    'srcaddr = 10.*.*.*, dstaddr != 10.*.*.*, srcport, dstport, '
-    'protocol, packets, bytes, start, end, action, log_status]')
+OUTPUT_MODE = "raw"
+STATE_DIR = "/flowlog/state"
 JSON_KEYS = ["flow_log_version", "aws_account_id", "nw_interface_id", 
     "srcaddr", "dstaddr", "srcport", "dstport", "protocol", "packets",
     "bytes", "estart_time", "eend_time", "nw_acl_action", "flowlog_status",
     "rstart_time", "rend_time", "instance_id", "instance_type", "instance_name",
-    "subnet_id", "ami_id", "dst_domainname"]
+    "subnet_id", "ami_id", "dst_domainname", "dst_class",
+    "dst_country", "dst_asn", "dst_as_org"]
 streamname_evetime_dict = {}
+ec2_index = None
+dns_resolver = None
+stream_registry = None
+flow_rollup = None
+cidr_classifier = None
+geoip = None
+window_planner = None
+partitioner = None
+call_scheduler = None
+enrichment_snapshot = None
+flow_sketch = None
+ENRICH_TIMER = metrics.StageTimer("stage_seconds", stage="enrich")
+EC2_LOOKUP_TIMER = metrics.StageTimer("stage_seconds", stage="ec2_lookup")
+DNS_TIMER = metrics.StageTimer("stage_seconds", stage="dns")
+GEOIP_TIMER = metrics.StageTimer("stage_seconds", stage="geoip")
+EVENTS_IN = metrics.Counter("events_in")
+EVENTS_OUT = metrics.Counter("events_out")
+EVENTS_NOT_EGRESS = metrics.Counter("events_dropped", reason="not_egress")
+EVENTS_DUPLICATE = metrics.Counter("events_dropped", reason="duplicate")
+EVENTS_LATE = metrics.Counter("events_late")
+#file object enriched documents are written to, stdout when None
+doc_output = None
+doc_writer = None
 
-def get_ec2instance_details(clients, src_ip):
-    ec2_client = clients[1]
-    try:
-        ec2_details = ec2_client.describe_instances(Filters=[{'Name':'private-ip-address','Values':[src_ip,]}])
-        return ec2_details
-    except:
-        print ("EXCEPTION: Could not call API describe_instances() with ", src_ip)
+#API_RATE_<API> calls/sec per API, e.g. API_RATE_FILTER_LOG_EVENTS
+def get_call_scheduler():
+    global call_scheduler
+    if call_scheduler is None:
+        rates = dict((api, float(os.environ.get("API_RATE_" + api.upper(), rate)))
+            for api, rate in API_RATES.items())
+        call_scheduler = CallScheduler(rates,
+            int(os.environ.get("API_MAX_RETRIES", API_MAX_RETRIES)),
+            float(os.environ.get("API_BACKOFF_BASE", API_BACKOFF_BASE)),
+            float(os.environ.get("API_BACKOFF_MAX", API_BACKOFF_MAX)))
+    return call_scheduler
+
+#throttles and transient errors are retried by the scheduler, not inside botocore
+def scheduled(client):
+    return ScheduledClient(client, get_call_scheduler())
+
+def aws_client(service):
+    return scheduled(boto3.client(service, config=Config(retries={"max_attempts": 0})))
+
+def get_ec2_index(clients):
+    global ec2_index
+    if ec2_index is None:
+        ec2_index = Ec2InstanceIndex(clients[1], os.environ.get("AWS_VPC_ID"),
+            int(os.environ.get("EC2_CACHE_TTL", EC2_CACHE_TTL)),
+            int(os.environ.get("EC2_NEGATIVE_CACHE_SIZE", EC2_NEGATIVE_CACHE_SIZE)),
+            int(os.environ.get("EC2_NEGATIVE_CACHE_TTL", EC2_NEGATIVE_CACHE_TTL)))
+        if get_enrichment_snapshot() is not None:
+            get_enrichment_snapshot().load_ec2(ec2_index)
+    return ec2_index
+
+def get_dns_resolver():
+    global dns_resolver
+    if dns_resolver is None:
+        dns_resolver = ReverseDnsResolver(mode=os.environ.get("DNS_MODE", DNS_MODE),
+            timeout=float(os.environ.get("DNS_TIMEOUT", DNS_TIMEOUT)),
+            workers=int(os.environ.get("DNS_WORKERS", DNS_WORKERS)),
+            cache_size=int(os.environ.get("DNS_CACHE_SIZE", DNS_CACHE_SIZE)),
+            cache_ttl=int(os.environ.get("DNS_CACHE_TTL", DNS_CACHE_TTL)),
+            negative_ttl=int(os.environ.get("DNS_NEGATIVE_TTL", DNS_NEGATIVE_TTL)))
+        if get_enrichment_snapshot() is not None and dns_resolver.mode != "off":
+            get_enrichment_snapshot().load_dns(dns_resolver)
+    return dns_resolver
+
+#ENRICH_SNAPSHOT: sqlite file the EC2 inventory and PTR cache are saved to
+#and warm started from, "off" to disable
+def get_enrichment_snapshot():
+    global enrichment_snapshot
+    path = os.environ.get("ENRICH_SNAPSHOT", os.path.join(STATE_DIR, SNAPSHOT_FILE))
+    if enrichment_snapshot is None and path != "off":
+        enrichment_snapshot = EnrichmentSnapshot(path,
+            int(os.environ.get("ENRICH_SNAPSHOT_INTERVAL", SNAPSHOT_INTERVAL)),
+            int(os.environ.get("ENRICH_SNAPSHOT_MAX_AGE", SNAPSHOT_MAX_AGE)))
+    return enrichment_snapshot
+
+def save_enrichment_snapshot(clients, force=False):
+    snapshot = get_enrichment_snapshot()
+    if snapshot is None:
+        return
+    if force:
+        snapshot.save(get_ec2_index(clients), get_dns_resolver())
+    else:
+        snapshot.maybe_save(get_ec2_index(clients), get_dns_resolver())
+
+#GEOIP_DB: comma separated ASN/country range files and/or ip-ranges.json,
+#compiled into GEOIP_INDEX; None when neither is configured
+def get_geoip():
+    global geoip
+    if geoip is None and (os.environ.get("GEOIP_DB") or os.environ.get("GEOIP_INDEX")):
+        sources = os.environ.get("GEOIP_DB", "")
+        geoip = GeoIpLookup([path for path in sources.split(",") if path],
+            os.environ.get("GEOIP_INDEX", os.path.join(STATE_DIR, GEOIP_INDEX)),
+            int(os.environ.get("GEOIP_CACHE_SIZE", GEOIP_CACHE_SIZE)),
+            int(os.environ.get("GEOIP_CHECK_INTERVAL", GEOIP_CHECK_INTERVAL)))
+    return geoip
+
+#INTERNAL_CIDRS (plus the AWS_VPC_ID CIDRs with USE_VPC_CIDRS=1), PEERED_CIDRS
+#and AWS_SERVICE_CIDRS, anything else is internet
+def get_cidr_classifier(clients=None):
+    global cidr_classifier
+    if cidr_classifier is None:
+        internal = split_cidrs(os.environ.get("INTERNAL_CIDRS", INTERNAL_CIDRS))
+        if (os.environ.get("USE_VPC_CIDRS", "0") == "1" and clients is not None
+                and clients[1] is not None and os.environ.get("AWS_VPC_ID") is not None):
+            try:
+                internal += vpc_cidrs(clients[1], os.environ.get("AWS_VPC_ID"))
+            except Exception as e:
+                metrics.api_error("describe_vpcs", e)
+                print ("EXCEPTION: Could not get CIDRs of VPC", os.environ.get("AWS_VPC_ID"), ":", e)
+        cidr_classifier = CidrClassifier(internal,
+            split_cidrs(os.environ.get("PEERED_CIDRS")),
+            split_cidrs(os.environ.get("AWS_SERVICE_CIDRS")),
+            split_cidrs(os.environ.get("EGRESS_CLASSES", EGRESS_CLASSES)))
+    return cidr_classifier
+
+#same selection as the generated filter pattern, for flows read without CloudWatch
+def is_egress_flow(flow_fields):
+    if len(flow_fields) < 14:
         return False
+    return get_cidr_classifier().is_egress(flow_fields[3], flow_fields[4])
+
+#parse_flow filter for CloudWatch events: the server-side pattern cannot
+#express every CIDR, the rest is dropped here before any int conversion
+def count_egress_flow(flow_fields):
+    if get_cidr_classifier().is_egress(flow_fields[3], flow_fields[4]):
+        return True
+    EVENTS_NOT_EGRESS.inc()
+    return False
+
+#starts the reverse lookups of a page's egress destinations together, so
+#enrichment finds them cached or in flight instead of resolving one by one
+def prefetch_dns(events):
+    resolver = get_dns_resolver()
+    if resolver.mode == "off":
+        return
+    classifier = get_cidr_classifier()
+    dstaddrs = set()
+    for event in events:
+        flow_fields = event['message'].split(' ', 5)
+        if len(flow_fields) > 5 and classifier.is_egress(flow_fields[3], flow_fields[4]):
+            dstaddrs.add(flow_fields[4])
+    resolver.prefetch(dstaddrs)
 
+def get_ec2instance_details(clients, src_ip, interface_id=None):
+    #no EC2 client: enrichment disabled, e.g. offline backfill
+    if clients[1] is None:
+        return False
+    with EC2_LOOKUP_TIMER:
+        details = get_ec2_index(clients).lookup(src_ip, interface_id)
+    if details is None:
+        return False
+    return details
+
+#raw_aws_egrflow is a flow log line or a FlowRecord already parsed with
+#an egress filter (parse_flow(..., is_egress_flow))
 def enrich_push_logs(clients, raw_aws_egrflow):
-    src_ip = "NONE"
-    dst_hostname = "NX"
-    start_time = "NONE"
-    end_time = "NONE"
-    vpc_id = "NONE"
+    with ENRICH_TIMER:
+        enrich_flow(clients, raw_aws_egrflow)
+
+def enrich_flow(clients, raw_aws_egrflow):
     instance_id = "NX_INSTANCE"
     instance_type = "NX_INSTANCE"
     instance_name = "NX_INSTANCE"
     subnet_id = "NX_INSTANCE"
     ami_id = "NX_INSTANCE"
-    final_flow = ""
-    reservations = {}
 
     #get each VPC raw log entry
-    flow_fields = raw_aws_egrflow.split(' ')
-    src_ip = flow_fields[3]
-    try:
-        dst_hostname = socket.gethostbyaddr(flow_fields[4])[0]
-    except:
-        pass
-    start_time = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(int(flow_fields[10])))
-    end_time = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(int(flow_fields[11])))
+    record = raw_aws_egrflow
+    if not isinstance(record, FlowRecord):
+        record = parse_flow(raw_aws_egrflow, count_egress_flow)
+        if record is None:
+            #None for non-egress flows too, those are counted by the filter
+            if raw_aws_egrflow.count(' ') < 13:
+                print ("EXCEPTION: could not parse flow log entry:", raw_aws_egrflow)
+            return
+    dst_class = get_cidr_classifier().classify(record.dstaddr)
+    with DNS_TIMER:
+        dst_hostname = get_dns_resolver().resolve(record.dstaddr)
+    dst_country, dst_asn, dst_as_org = GEOIP_NX, 0, GEOIP_NX
+    if get_geoip() is not None:
+        with GEOIP_TIMER:
+            dst_country, dst_asn, dst_as_org = get_geoip().lookup(record.dstaddr)
+    start_time = format_time(record.estart_time)
+    end_time = format_time(record.eend_time)
 
-    ec2_details = get_ec2instance_details(clients, src_ip)
+    ec2_details = get_ec2instance_details(clients, record.srcaddr, record.nw_interface_id)
 
     if ec2_details:
-        if len(ec2_details['Reservations']) > 0:
-            try:
-                reservations = ec2_details['Reservations'][0]
-                if 'Instances' in reservations:
-                    vpc_id = reservations['Instances'][0]['VpcId']
-                    instance_id = reservations['Instances'][0]['InstanceId']
-                    instance_type = reservations['Instances'][0]['InstanceType']
-                    #we can have multiple tags, say, Name, Owner etc.
-                    if 'Tags' in reservations['Instances'][0]:
-                        total_tags = len(reservations['Instances'][0]['Tags'])
-                        for i in range(total_tags):
-                            if 'Name' in reservations['Instances'][0]['Tags'][i]['Key']:
-                                instance_name = reservations['Instances'][0]['Tags'][i]['Value']
-                    subnet_id = reservations['Instances'][0]['SubnetId']
-                    ami_id = reservations['Instances'][0]['ImageId']
-            except:
-                print ("EXCEPTION: issue in parsing ec2_details:", ec2_details)
-                pass
-    final_flow = raw_aws_egrflow + " " + start_time + " " + end_time  + \
-            " " + instance_id + " " + instance_type + " " + instance_name + \
-            " " + subnet_id + " " + ami_id + " " + dst_hostname
-    #print (final_flow)
-    print (json.dumps(dict(zip(JSON_KEYS,final_flow.split(" ")))))
+        instance_id = ec2_details['instance_id']
+        instance_type = ec2_details['instance_type']
+        instance_name = ec2_details['instance_name']
+        subnet_id = ec2_details['subnet_id']
+        ami_id = ec2_details['ami_id']
+    final_flow = record.values() + (start_time, end_time, instance_id, instance_type,
+        instance_name, subnet_id, ami_id, dst_hostname, dst_class,
+        dst_country, dst_asn, dst_as_org)
+    push_flow(dict(zip(JSON_KEYS, final_flow)))
+
+def make_sink(sink_name):
+    if sink_name == "sensu":
+        handlers = os.environ.get("SENSU_HANDLERS", "")
+        return SensuSink(os.environ.get("SENSU_HOST", SENSU_HOST),
+            int(os.environ.get("SENSU_PORT", SENSU_PORT)),
+            os.environ.get("SENSU_PROTO", SENSU_PROTO),
+            os.environ.get("SENSU_CHECK_NAME", SENSU_CHECK_NAME),
+            [handler for handler in handlers.split(",") if handler])
+    if sink_name == "file":
+        return RotatingFileSink(os.environ.get("OUTPUT_FILE_DIR", OUTPUT_FILE_DIR),
+            OUTPUT_FILE_PREFIX,
+            int(os.environ.get("OUTPUT_FILE_MAX_BYTES", OUTPUT_FILE_MAX_BYTES)),
+            int(os.environ.get("OUTPUT_FILE_KEEP", OUTPUT_FILE_KEEP)))
+    return StdoutSink()
+
+#OUTPUT_SINK stdout writes inline, sensu/file go through a bounded buffer
+def get_doc_writer():
+    global doc_writer
+    if doc_writer is None:
+        batch_size = int(os.environ.get("OUTPUT_BATCH_SIZE", OUTPUT_BATCH_SIZE))
+        sink_name = os.environ.get("OUTPUT_SINK", OUTPUT_SINK)
+        if doc_output is not None or sink_name == "stdout":
+            doc_writer = NdjsonWriter(doc_output, batch_size)
+        else:
+            doc_writer = BufferedOutput(make_sink(sink_name),
+                int(os.environ.get("OUTPUT_BUFFER_SIZE", OUTPUT_BUFFER_SIZE)), batch_size,
+                float(os.environ.get("OUTPUT_FLUSH_INTERVAL", OUTPUT_FLUSH_INTERVAL)))
+    return doc_writer
+
+#flushes pending documents and sends the following ones to fh (None: stdout)
+def set_doc_output(fh):
+    global doc_output, doc_writer
+    if doc_writer is not None:
+        doc_writer.close()
+    doc_output = fh
+    doc_writer = None
+
+def flush_docs():
+    if doc_writer is not None:
+        doc_writer.flush()
+
+def emit_doc(doc):
+    EVENTS_OUT.inc()
+    get_doc_writer().write(doc)
+
+def get_flow_rollup():
+    global flow_rollup
+    if flow_rollup is None:
+        flow_rollup = FlowRollup(emit_doc,
+            os.environ.get("ROLLUP_KEYS", ROLLUP_KEYS).split(","),
+            int(os.environ.get("ROLLUP_WINDOW", ROLLUP_WINDOW)),
+            int(os.environ.get("ROLLUP_LATENESS", ROLLUP_LATENESS)),
+            int(os.environ.get("ROLLUP_MAX_KEYS", ROLLUP_MAX_KEYS)))
+    return flow_rollup
+
+#SKETCH_TOPK > 0: top talkers and new destination alerts per window, next
+#to whatever OUTPUT_MODE emits; None when off
+def get_flow_sketch():
+    global flow_sketch
+    topk = int(os.environ.get("SKETCH_TOPK", SKETCH_TOPK))
+    if flow_sketch is None and topk > 0:
+        sketch_state = os.environ.get("SKETCH_STATE", state_path(SKETCH_STATE_FILE))
+        flow_sketch = FlowSketch(emit_doc, topk,
+            os.environ.get("SKETCH_KEYS", SKETCH_KEYS).split(","),
+            os.environ.get("SKETCH_NEW_KEYS", SKETCH_NEW_KEYS).split(","),
+            int(os.environ.get("SKETCH_WINDOW", SKETCH_WINDOW)),
+            int(os.environ.get("SKETCH_LATENESS", SKETCH_LATENESS)),
+            int(os.environ.get("SKETCH_COUNTERS", SKETCH_COUNTERS)),
+            int(os.environ.get("SKETCH_WIDTH", SKETCH_WIDTH)),
+            int(os.environ.get("SKETCH_DEPTH", SKETCH_DEPTH)),
+            int(os.environ.get("SKETCH_SEEN_CAPACITY", SKETCH_SEEN_CAPACITY)),
+            float(os.environ.get("SKETCH_SEEN_ERROR", SKETCH_SEEN_ERROR)),
+            int(os.environ.get("SKETCH_MAX_ALERTS", SKETCH_MAX_ALERTS)),
+            None if sketch_state == "off" else sketch_state)
+    return flow_sketch
+
+#emits the still open rollup and sketch windows as partial on exit, before
+#checkpoints and leases are handed over (atexit runs it first)
+def flush_aggregates():
+    if flow_rollup is not None:
+        flow_rollup.flush_all()
+    if flow_sketch is not None:
+        flow_sketch.flush_all()
+    flush_docs()
+
+#OUTPUT_MODE raw: one doc per flow, rollup: windowed totals, both: both
+def push_flow(flow):
+    output_mode = os.environ.get("OUTPUT_MODE", OUTPUT_MODE)
+    if output_mode != "rollup":
+        emit_doc(flow)
+    if output_mode != "raw":
+        get_flow_rollup().add(flow)
+    if get_flow_sketch() is not None:
+        get_flow_sketch().add(flow)
 
 #check environment
 def read_environment_variables():
@@ -119,31 +392,25 @@ def read_environment_variables():
     else:
         print ("All ENV variables are set")
 
-def get_logstreams(clients):
-    logStreamFullList = []
-    logstream_kwargs = {}
-    logs_client = clients[0]
+def get_stream_registry():
+    global stream_registry
+    if stream_registry is None:
+        log_grp_name = (str(os.environ.get("VPC_LOG_GROUP_NAME"))).strip()
+        stream_registry = StreamRegistry(log_grp_name,
+            int(os.environ.get("STREAM_IDLE_GRACE", STREAM_IDLE_GRACE)),
+            int(os.environ.get("STREAM_RETENTION", STREAM_RETENTION)))
+    return stream_registry
 
-    log_grp_name = (str(os.environ.get("VPC_LOG_GROUP_NAME"))).strip()
-    #descending is false by default
-    logstream_kwargs["logGroupName"] = log_grp_name
-    logstream_kwargs["orderBy"] = "LastEventTime" 
+def get_logstreams(clients, start_time=0):
+    logs_client = clients[0]
+    registry = get_stream_registry()
 
-    try:
-        print ("INFO: getting LogStreams from LogGroup:", log_grp_name)
-        paginator = logs_client.get_paginator('describe_log_streams')
-        ls_page_iterator = paginator.paginate(**logstream_kwargs)
-        for logstream in ls_page_iterator:
-            #check atleast one log group name is returned
-            if len(logstream["logStreams"]) >= 1:
-                logStreamFullList.extend(logstream["logStreams"])
-            else:
-                continue
-    except PaginationError as e:
-        print ("EXCEPTION: describe_log_streams Paginator:", e.kwargs['message'])
-        pass
+    print ("INFO: getting LogStreams from LogGroup:", registry.log_grp_name)
+    #newest first, stops paging once streams are idle since before start_time
+    with metrics.timer("stage_seconds", stage="list_streams"):
+        registry.refresh(logs_client, start_time)
     
-    return logStreamFullList
+    return registry.all_streams()
 
 def reading_streams_firsttime(lstreams_list):
     global streamname_evetime_dict
@@ -155,35 +422,207 @@ def reading_streams_firsttime(lstreams_list):
     print ("INFO: Total LogStreams:", len(streamname_evetime_dict.keys()))
     print ("INFO: List of LogStreams:", streamname_evetime_dict.keys())
 
-#generator function 
-def get_eve_per_logstream(clients, logStreamFullList, start_time, end_time):
+#generator function, events with timestamps in [start_time, end_time)
+def get_eve_per_logstream(clients, logStreamFullList, start_time, end_time, progress=None,
+        checkpoints=None, track_tokens=True):
     filterevents_kwargs = {}
     log_grp_name = (os.environ.get("VPC_LOG_GROUP_NAME")).strip()
     logs_client = clients[0]
     filterevents_kwargs['logGroupName'] = log_grp_name
-    #hack: updating filterevents_kwargs with start, end times not working as expected 
-    UPDATED_EGRESS_FILTER = EGRESS_FILTER.replace("start", "start >= " + str(start_time))
-    UPDATED_EGRESS_FILTER = UPDATED_EGRESS_FILTER.replace("end", "end < " + str(end_time))
-    filterevents_kwargs['filterPattern'] = UPDATED_EGRESS_FILTER 
-    #default, old logs first new logs at last, descending
-    for lstream in logStreamFullList:
-        filterevents_kwargs['logStreamNames'] = [(str(lstream["logStreamName"])).strip()]
-        print ("INFO: log stream name:", filterevents_kwargs['logStreamNames'])
-        print ("INFO: log group name:", filterevents_kwargs['logGroupName'])
-        print ("INFO: start_time:", start_time, "end_time:", end_time)
-        #parse logs from firs call to API, we are here only once
-        log_pages = logs_client.get_paginator('filter_log_events')
-        log_iterator  = log_pages.paginate(**filterevents_kwargs)
-        #call if there are log events key and there is atleast one event
-        try:
-            for logpage in log_iterator:
-                print ("INFO: Total logs retrieved in this page:", len(logpage['events']))
-                for event in logpage['events']:
-                    yield event
-        except PaginationError as e:
-            print ("EXCEPTION: filter_log_events Paginator: ", e.kwargs['message'])
-            pass
+    #http://docs.aws.amazon.com/AmazonCloudWatch/latest/logs/FilterAndPatternSyntax.html
+    filterevents_kwargs['filterPattern'] = get_cidr_classifier(clients).filter_pattern()
+    #overlaps the previous window by WINDOW_GRACE to pick up late ingested events
+    grace = int(os.environ.get("WINDOW_GRACE", WINDOW_GRACE))
+    #milliseconds, endTime is inclusive
+    filterevents_kwargs['startTime'] = (start_time - grace) * 1000
+    filterevents_kwargs['endTime'] = end_time * 1000 - 1
+    #streams without events since before the window have nothing to read
+    active_list = get_stream_registry().active_streams(logStreamFullList, start_time - grace)
+    stream_names = [(str(lstream["logStreamName"])).strip() for lstream in active_list]
+    print ("INFO: log group name:", filterevents_kwargs['logGroupName'])
+    print ("INFO: start_time:", start_time, "end_time:", end_time)
+    if progress is None:
+        progress = {}
+    stream_kwargs = {}
+    on_page_done = None
+    if checkpoints is not None:
+        #resume each stream from its committed high-water mark
+        for stream_name in stream_names:
+            checkpoint = checkpoints.stream(stream_name)
+            if checkpoint is None:
+                continue
+            if checkpoint['timestamp'] - grace * 1000 > filterevents_kwargs['startTime']:
+                stream_kwargs[stream_name] = {'startTime': checkpoint['timestamp'] - grace * 1000}
+            if checkpoint.get('until') is not None and checkpoint['until'] < filterevents_kwargs['startTime']:
+                #taken over from a worker whose windows ended before this one starts
+                stream_kwargs[stream_name] = {'startTime':
+                    max(checkpoint['until'], checkpoint['timestamp']) - grace * 1000}
+            if track_tokens and checkpoints.token(stream_name) is not None:
+                #a token only continues the query it came from
+                stream_kwargs[stream_name] = {'PaginationConfig': {
+                    'StartingToken': checkpoints.token(stream_name)}}
+                if checkpoint.get('token_start') is not None:
+                    stream_kwargs[stream_name]['startTime'] = checkpoint['token_start']
+    if checkpoints is not None and track_tokens:
+        def on_page_done(stream_name, next_token):
+            checkpoints.set_token(stream_name, next_token,
+                stream_kwargs.get(stream_name, {}).get('startTime'))
+    #streams are paged concurrently, events arrive through a bounded queue
+    for event in fetch_streams(logs_client, filterevents_kwargs, stream_names, progress,
+            int(os.environ.get("FETCH_CONCURRENCY", FETCH_CONCURRENCY)),
+            int(os.environ.get("FETCH_QUEUE_SIZE", FETCH_QUEUE_SIZE)),
+            stream_kwargs, on_page_done, prefetch_dns):
+        EVENTS_IN.inc()
+        if checkpoints is not None and checkpoints.is_processed(
+                event['logStreamName'], event['timestamp'], event['eventId']):
+            EVENTS_DUPLICATE.inc()
+            continue
+        yield event
+    failed = [name for name in progress if progress[name].error is not None]
+    print ("INFO: Total events retrieved:", sum(p.events for p in progress.values()),
+        "from", len(progress), "LogStreams, failed:", failed)
  
+def get_worker_id():
+    return os.environ.get("WORKER_ID", socket.gethostname())
+
+#WORKER_DIR: directory shared by all workers of the log group, None when
+#this process reads every stream
+def get_partitioner():
+    global partitioner
+    if partitioner is None and os.environ.get("WORKER_DIR") is not None:
+        partitioner = StreamPartitioner(FileLeaseStore(os.environ.get("WORKER_DIR"),
+            int(os.environ.get("WORKER_LEASE_TTL", WORKER_LEASE_TTL))),
+            get_worker_id(), int(os.environ.get("WORKER_VNODES", WORKER_VNODES)))
+        partitioner.start()
+    return partitioner
+
+#every worker keeps its own start_time/checkpoints, even in a shared STATE_DIR
+def state_path(name):
+    if os.environ.get("WORKER_DIR") is None:
+        return os.path.join(STATE_DIR, name)
+    base, ext = os.path.splitext(name)
+    return os.path.join(STATE_DIR, "%s-%s%s" % (base, get_worker_id(), ext))
+
+#passed to the next owner of a stream: the last event processed and the end
+#of the last committed window, events from there on are not read yet
+def stream_handoff(checkpoints, stream_name):
+    checkpoint = checkpoints.stream(stream_name) or {"timestamp": 0, "event_id": None}
+    handoff = {"timestamp": checkpoint["timestamp"], "event_id": checkpoint.get("event_id")}
+    if checkpoints.committed_start() is not None:
+        handoff["until"] = checkpoints.committed_start() * 1000
+    return handoff
+
+#keys are "<log group>/<stream>" so streams of several groups can share a ring
+def partition_streams(lstreams_list, checkpoints):
+    prefix = get_stream_registry().log_grp_name + "/"
+    granted = get_partitioner().assign([prefix + lstream["logStreamName"] for lstream in lstreams_list],
+        lambda key: stream_handoff(checkpoints, key[len(prefix):]))
+    owned = []
+    for lstream in lstreams_list:
+        key = prefix + lstream["logStreamName"]
+        if key not in granted:
+            continue
+        if granted[key] is not None:
+            checkpoints.seed(lstream["logStreamName"], granted[key])
+        owned.append(lstream)
+    return owned
+
+#stores the committed checkpoints with this worker's claims, a worker taking
+#over after a crash resumes from them instead of its own window start
+def publish_workers(checkpoints):
+    if partitioner is None:
+        return
+    prefix = get_stream_registry().log_grp_name + "/"
+    try:
+        partitioner.publish(lambda key: stream_handoff(checkpoints, key[len(prefix):]))
+    except (OSError, ValueError) as e:
+        print ("EXCEPTION: could not publish stream checkpoints:", e)
+
+#gives this worker's streams back, with their checkpoints, on exit
+def leave_workers(checkpoints):
+    if partitioner is None:
+        return
+    flush_docs()
+    checkpoints.flush()
+    prefix = get_stream_registry().log_grp_name + "/"
+    partitioner.close(lambda key: stream_handoff(checkpoints, key[len(prefix):]))
+
+def get_window_planner():
+    global window_planner
+    if window_planner is None:
+        window_planner = WindowPlanner(int(os.environ.get("WINDOW_MIN", WINDOW_MIN)),
+            int(os.environ.get("WINDOW_MAX", WINDOW_MAX)),
+            int(os.environ.get("WINDOW_INITIAL", WINDOW_INITIAL)),
+            int(os.environ.get("WINDOW_TARGET_EVENTS", WINDOW_TARGET_EVENTS)))
+    return window_planner
+
+def fetch_window(clients, lstreams_list, start_time, end_time, checkpoints, window):
+    try:
+        for event in get_eve_per_logstream(clients, lstreams_list, start_time, end_time,
+                window.progress, checkpoints=checkpoints, track_tokens=False):
+            if not window.put(event):
+                return
+    finally:
+        window.finish()
+
+#generator, splits [start_time, end_time) into planned windows and yields
+#(window_start, window_end, events, progress) in window order. With WINDOW_PARALLEL > 1
+#the next windows are fetched on background threads while one is enriched,
+#each buffering up to WINDOW_PREFETCH_EVENTS; a window not fetched ahead is
+#streamed and keeps its pagination tokens
+def fetch_windows(clients, lstreams_list, start_time, end_time, checkpoints=None):
+    planner = get_window_planner()
+    parallel = int(os.environ.get("WINDOW_PARALLEL", WINDOW_PARALLEL))
+    prefetch_events = int(os.environ.get("WINDOW_PREFETCH_EVENTS", WINDOW_PREFETCH_EVENTS))
+    first_event, last_event = get_stream_registry().event_bounds(lstreams_list)
+    #a resumed window is redone exactly, saved tokens belong to it
+    resume = checkpoints is not None and checkpoints.window_in_progress() == (start_time, end_time)
+    executor = None
+    if parallel > 1:
+        executor = ThreadPoolExecutor(max_workers=parallel - 1)
+    ahead = deque()
+    window = None
+    next_start = start_time
+    try:
+        while next_start < end_time or ahead:
+            if ahead:
+                window_start, window_end, window = ahead.popleft()
+                events = window.events()
+                progress = window.progress
+            else:
+                window = None
+                window_start = next_start
+                window_end = end_time
+                if not resume:
+                    window_end = planner.next_end(window_start, end_time, first_event, last_event)
+                next_start = window_end
+                progress = {}
+                events = get_eve_per_logstream(clients, lstreams_list, window_start, window_end,
+                    progress, checkpoints=checkpoints)
+            while executor is not None and len(ahead) < parallel - 1 and next_start < end_time:
+                ahead_end = planner.next_end(next_start, end_time, first_event, last_event)
+                prefetch = PrefetchedWindow(prefetch_events)
+                prefetch.future = executor.submit(fetch_window, clients, lstreams_list,
+                    next_start, ahead_end, checkpoints, prefetch)
+                ahead.append((next_start, ahead_end, prefetch))
+                next_start = ahead_end
+            metrics.set_gauge("window_seconds", window_end - window_start)
+            yield window_start, window_end, events, progress
+    finally:
+        #stops the fetches still running, also of a window left unfinished
+        if window is not None:
+            window.close()
+        for window_start, window_end, prefetch in ahead:
+            prefetch.close()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+#streams whose query failed part way; a deleted stream has nothing left to lose
+def failed_streams(progress):
+    return [stream_name for stream_name, stream_progress in progress.items()
+        if stream_progress.error is not None and getattr(stream_progress.error, "response", {})
+            .get("Error", {}).get("Code") != "ResourceNotFoundException"]
+
 def run_as_service(clients):
     serv_count = 0
     lstreams_list= []
@@ -192,16 +631,18 @@ def run_as_service(clients):
     if os.environ.get("START_READING_LOGS_EPOCHTIME") is not None:
         start_time = int(os.environ.get("START_READING_LOGS_EPOCHTIME"))
 
+    start_time_path = state_path("start_time")
     #reads file data from external volume, create new file if not present
-    if os.path.isfile("/flowlog/state/start_time"):
-        fh = open("/flowlog/state/start_time","r")
+    if os.path.isfile(start_time_path):
+        fh = open(start_time_path,"r")
         ts = fh.read()
+        fh.close()
         if len(ts) > 8:
             start_time = int(ts)
     else:
         #create file
         try:
-            fh = open("/flowlog/state/start_time","w")
+            fh = open(start_time_path,"w")
             fh.close()
         except:
             print ("EXCEPTION: directory /flowlog/state/ not present")
@@ -212,6 +653,31 @@ def run_as_service(clients):
         print ("INFO: START_READING_LOGS_EPOCHTIME not set. Reading logs from beginning!")
     #get current/now time
     end_time = int(time.time())
+
+    grace = int(os.environ.get("WINDOW_GRACE", WINDOW_GRACE))
+    deduper = None
+    if grace > 0:
+        deduper = EventDeduper(int(os.environ.get("DEDUP_BUCKET", DEDUP_BUCKET)),
+            int(os.environ.get("DEDUP_CAPACITY", DEDUP_CAPACITY)),
+            float(os.environ.get("DEDUP_ERROR", DEDUP_ERROR)))
+    checkpoints = CheckpointStore(state_path(CHECKPOINT_FILE),
+        int(os.environ.get("CHECKPOINT_FLUSH_EVENTS", CHECKPOINT_FLUSH_EVENTS)),
+        int(os.environ.get("CHECKPOINT_FLUSH_INTERVAL", CHECKPOINT_FLUSH_INTERVAL)),
+        os.environ.get("CHECKPOINT_TOKENS", "0") == "1", deduper, grace, flush_docs,
+        int(os.environ.get("STREAM_IDLE_GRACE", STREAM_IDLE_GRACE)))
+    checkpoints.load()
+    atexit.register(leave_workers, checkpoints)
+    atexit.register(save_enrichment_snapshot, clients, True)
+    atexit.register(flush_aggregates)
+    #crashed mid-cycle: redo the same window so saved tokens stay valid
+    if checkpoints.window_in_progress() is not None:
+        start_time, end_time = checkpoints.window_in_progress()
+        print ("INFO: resuming window start_time:", start_time, "end_time:", end_time)
+    elif checkpoints.committed_start() is not None and checkpoints.committed_start() > start_time:
+        start_time = checkpoints.committed_start()
+    #loads the VPC CIDRs before the first filter pattern is built
+    print ("INFO: CIDR classes:", get_cidr_classifier(clients).stats(),
+        "filter pattern:", get_cidr_classifier(clients).filter_pattern())
     
     while True:
         call_count = 0
@@ -220,7 +686,7 @@ def run_as_service(clients):
                 print ("ERROR: Could not get LogStreams even after %d attempts. Exiting!" % (call_count))
                 sys.exit(-1)
 
-            lstreams_list = get_logstreams(clients)
+            lstreams_list = get_logstreams(clients, start_time)
 
             if len(lstreams_list) < 1:
                 print ("INFO: Could not get LogStreams(%d). Requesting again after 10 sec!" % (call_count+1))
@@ -233,13 +699,75 @@ def run_as_service(clients):
             #reading_streams_firsttime(lstreams_list)
         #else:
         print ("INFO: Total LogStreams:", len(lstreams_list))
+        if get_partitioner() is not None:
+            #only streams this worker holds a claim on, at cycle boundaries
+            lstreams_list = partition_streams(lstreams_list, checkpoints)
+            print ("INFO: Worker stats:", get_partitioner().stats())
+        #bulk load instance inventory once per cycle instead of per event,
+        #a warm (snapshot) inventory keeps serving while it reloads
+        get_ec2_index(clients).refresh_if_stale(background=True)
         if serv_count > 0:
             start_time = end_time
             end_time = int(time.time())
 
-        #generator returns
-        for event in get_eve_per_logstream(clients, lstreams_list, start_time, end_time):
-            enrich_push_logs(clients, event['message'])
+        cycle_started = time.time()
+        #every window is committed before the next one starts, in time order
+        for window_start, window_end, events, progress in fetch_windows(clients, lstreams_list,
+                start_time, end_time, checkpoints):
+            checkpoints.begin_window(window_start, window_end)
+            window_events = 0
+            for event in events:
+                #windows fetched ahead were filtered before the previous one was done
+                if checkpoints.is_processed(event['logStreamName'], event['timestamp'], event['eventId']):
+                    EVENTS_DUPLICATE.inc()
+                    continue
+                if checkpoints.is_late(event['logStreamName'], event['timestamp']):
+                    EVENTS_LATE.inc()
+                enrich_push_logs(clients, event['message'])
+                checkpoints.advance(event['logStreamName'], event['timestamp'], event['eventId'])
+                window_events += 1
+            failed = failed_streams(progress)
+            if failed:
+                #not committed: the next cycle redoes this window, the events
+                #already processed are skipped by their checkpoints
+                print ("INFO: LogStreams failed, retrying window", window_start, "-", window_end, ":", failed)
+                metrics.inc("window_retries")
+                flush_docs()
+                checkpoints.flush()
+                end_time = window_start
+                break
+            get_window_planner().observe(window_end - window_start, window_events)
+            if os.environ.get("OUTPUT_MODE", OUTPUT_MODE) != "raw":
+                get_flow_rollup().tick()
+            if get_flow_sketch() is not None:
+                get_flow_sketch().tick()
+            flush_docs()
+            checkpoints.commit_window()
+            publish_workers(checkpoints)
+            try:
+                atomic_write(start_time_path, str(window_end))
+            except OSError as e:
+                print ("EXCEPTION: could not write", start_time_path, ":", e)
+            #how far the processed window trails real time
+            metrics.set_gauge("lag_seconds", int(time.time()) - window_end)
+            metrics.set_gauge("window_end_seconds", window_end)
+        metrics.observe("cycle_seconds", time.time() - cycle_started)
+        if os.environ.get("OUTPUT_MODE", OUTPUT_MODE) != "raw":
+            print ("INFO: Rollup stats:", get_flow_rollup().stats())
+        if get_flow_sketch() is not None:
+            print ("INFO: Sketch stats:", get_flow_sketch().stats())
+        if os.environ.get("METRICS_TEXTFILE") is not None:
+            metrics.write_textfile(os.environ.get("METRICS_TEXTFILE"))
+        print ("INFO: EC2 cache stats:", get_ec2_index(clients).stats())
+        print ("INFO: DNS cache stats:", get_dns_resolver().stats())
+        print ("INFO: LogStream stats:", get_stream_registry().stats())
+        print ("INFO: Window stats:", get_window_planner().stats())
+        if checkpoints.deduper is not None:
+            print ("INFO: Dedup stats:", checkpoints.deduper.stats())
+        print ("INFO: AWS API stats:", get_call_scheduler().stats())
+        if get_geoip() is not None:
+            print ("INFO: GeoIP stats:", get_geoip().stats())
+        save_enrichment_snapshot(clients)
 
         #used to check if we are in while loop for the first time
         serv_count += 1
@@ -247,15 +775,166 @@ def run_as_service(clients):
         print ("SLEEP between API calls: ", int(os.environ.get("SLEEP")))
         time.sleep(int(os.environ.get("SLEEP"))) 
     
+#stream names to follow, and tokens handed over by their previous owners
+def tail_streams(active_list, tailer):
+    stream_names = [lstream["logStreamName"] for lstream in active_list]
+    if get_partitioner() is None:
+        return stream_names, None
+    prefix = get_stream_registry().log_grp_name + "/"
+    tokens = tailer.tokens()
+    granted = get_partitioner().assign([prefix + name for name in stream_names],
+        lambda key: {"tail_token": tokens.get(key[len(prefix):])})
+    handoffs = dict((key[len(prefix):], (checkpoint or {}).get("tail_token"))
+        for key, checkpoint in granted.items())
+    return list(handoffs), handoffs
+
+def leave_tail(tailer, tail_path):
+    flush_docs()
+    tailer.save(tail_path)
+    if partitioner is not None:
+        tokens = tailer.tokens()
+        prefix = get_stream_registry().log_grp_name + "/"
+        partitioner.close(lambda key: {"tail_token": tokens.get(key[len(prefix):])})
+
+#TAIL_MODE=1: every active stream is followed with get_log_events forward
+#tokens instead of windowed scans, events are enriched and flushed as soon
+#as a poll returns; streams without a saved cursor start at start_time
+def run_tail(clients):
+    start_time = int(os.environ.get("START_READING_LOGS_EPOCHTIME", 0))
+    if os.path.isfile(state_path("start_time")):
+        with open(state_path("start_time"), "r") as fh:
+            ts = fh.read()
+        if len(ts) > 8:
+            start_time = int(ts)
+    tail_path = state_path(TAIL_STATE_FILE)
+    tailer = StreamTailer(get_stream_registry().log_grp_name, start_time,
+        float(os.environ.get("TAIL_MIN_INTERVAL", TAIL_MIN_INTERVAL)),
+        float(os.environ.get("TAIL_MAX_INTERVAL", TAIL_MAX_INTERVAL)),
+        int(os.environ.get("TAIL_PAGE_LIMIT", TAIL_PAGE_LIMIT)))
+    tailer.load(tail_path)
+    atexit.register(leave_tail, tailer, tail_path)
+    atexit.register(save_enrichment_snapshot, clients, True)
+    atexit.register(flush_aggregates)
+    print ("INFO: CIDR classes:", get_cidr_classifier(clients).stats())
+    concurrency = int(os.environ.get("TAIL_CONCURRENCY", TAIL_CONCURRENCY))
+    list_interval = int(os.environ.get("TAIL_LIST_INTERVAL", TAIL_LIST_INTERVAL))
+    flush_interval = int(os.environ.get("TAIL_FLUSH_INTERVAL", TAIL_FLUSH_INTERVAL))
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    running = {}
+    listed_at = 0
+    flushed_at = time.time()
+
+    def handle(future):
+        cursor = running.pop(future)
+        events, token = future.result()
+        if events:
+            prefetch_dns(events)
+            for event in events:
+                EVENTS_IN.inc()
+                enrich_push_logs(clients, event['message'])
+            #CloudWatch ingestion to output
+            metrics.observe("tail_delivery_seconds",
+                time.time() - events[-1].get("ingestionTime", events[-1]["timestamp"]) / 1000.0)
+        tailer.done(cursor, events, token, time.time())
+
+    while True:
+        if time.time() - listed_at >= list_interval:
+            #streams change owner only with no poll in flight
+            for future in list(running):
+                future.result()
+                handle(future)
+            flush_docs()
+            listed_at = time.time()
+            lstreams_list = get_logstreams(clients, int(tailer.list_from(listed_at)))
+            recent = set(lstream["logStreamName"] for lstream in
+                get_stream_registry().active_streams(lstreams_list, int(listed_at)))
+            active_list = [lstream for lstream in lstreams_list
+                if lstream["logStreamName"] in recent or tailer.behind(lstream)]
+            tailer.sync(*tail_streams(active_list, tailer))
+            get_ec2_index(clients).refresh_if_stale(background=True)
+            save_enrichment_snapshot(clients)
+            print ("INFO: Tail stats:", tailer.stats())
+            print ("INFO: AWS API stats:", get_call_scheduler().stats())
+        for cursor in tailer.due(time.time())[:max(0, concurrency - len(running))]:
+            cursor.busy = True
+            running[executor.submit(tailer.poll, clients[0], cursor)] = cursor
+        wakeup = listed_at + list_interval
+        if tailer.next_wakeup() is not None:
+            wakeup = min(wakeup, tailer.next_wakeup())
+        timeout = max(0.05, wakeup - time.time())
+        if running:
+            finished = wait(running, timeout, FIRST_COMPLETED).done
+        else:
+            time.sleep(timeout)
+            finished = []
+        for future in finished:
+            handle(future)
+        if finished:
+            flush_docs()
+        if time.time() - flushed_at >= flush_interval:
+            if os.environ.get("OUTPUT_MODE", OUTPUT_MODE) != "raw":
+                get_flow_rollup().tick()
+            if get_flow_sketch() is not None:
+                get_flow_sketch().tick()
+            flush_docs()
+            tailer.save(tail_path)
+            if partitioner is not None:
+                tokens = tailer.tokens()
+                prefix = get_stream_registry().log_grp_name + "/"
+                try:
+                    partitioner.publish(lambda key: {"tail_token": tokens.get(key[len(prefix):])})
+                except (OSError, ValueError) as e:
+                    print ("EXCEPTION: could not publish stream checkpoints:", e)
+            flushed_at = time.time()
+            if os.environ.get("METRICS_TEXTFILE") is not None:
+                metrics.write_textfile(os.environ.get("METRICS_TEXTFILE"))
+
+def cache_metrics():
+    samples = []
+    caches = [("ec2", ec2_index), ("dns", dns_resolver), ("geoip", geoip)]
+    for cache_name, cache in caches:
+        if cache is None:
+            continue
+        cache_stats = cache.stats()
+        lookups = cache_stats["hits"] + cache_stats["misses"]
+        samples.append(("cache_hits", {"cache": cache_name}, cache_stats["hits"]))
+        samples.append(("cache_misses", {"cache": cache_name}, cache_stats["misses"]))
+        if lookups > 0:
+            samples.append(("cache_hit_ratio", {"cache": cache_name}, cache_stats["hits"] / lookups))
+    if call_scheduler is not None:
+        for api, api_stats in call_scheduler.stats().items():
+            samples.append(("api_rate_limit", {"api": api}, api_stats["rate"]))
+            samples.append(("api_wait_seconds", {"api": api}, api_stats["waited"]))
+            samples.append(("api_coalesced", {"api": api}, api_stats["coalesced"]))
+    if stream_registry is not None:
+        for key, value in stream_registry.stats().items():
+            samples.append(("log_streams", {"state": key}, value))
+    return samples
+
+#METRICS_PORT serves /metrics, METRICS_TEXTFILE is rewritten every cycle
+def start_metrics():
+    if os.environ.get("METRICS_PORT") is None and os.environ.get("METRICS_TEXTFILE") is None:
+        return
+    metrics.enabled = True
+    metrics.register_collector(cache_metrics)
+    if os.environ.get("METRICS_PORT") is not None:
+        metrics.start_http_server(int(os.environ.get("METRICS_PORT")))
+
 def main():
     clients = []
 
     read_environment_variables()
+    start_metrics()
+    #exit cleanly so atexit hands streams over to the other workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
-    clients.append(boto3.client('logs'))
-    clients.append(boto3.client('ec2'))
+    clients.append(aws_client('logs'))
+    clients.append(aws_client('ec2'))
     #infinite loop
-    run_as_service(clients)
+    if os.environ.get("TAIL_MODE", "0") == "1":
+        run_tail(clients)
+    else:
+        run_as_service(clients)
     
 if __name__ == '__main__':
     main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import shutil
+import argparse
+import tempfile
+from multiprocessing import Pool
+import get_flowlogs
+from flowlog_record import parse_flow
+
+BACKFILL_WORKERS = os.cpu_count() or 1
+worker_clients = None
+
+def open_flowlog(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+#the flow log message of a line, None for header lines
+def flow_message_from_line(line):
+    message = line.strip()
+    first, sep, rest = message.partition(' ')
+    #CloudWatch export to S3 prefixes every event with its ISO timestamp
+    if first.endswith("Z") and "T" in first and rest.count(' ') >= 13:
+        return rest
+    #S3 flow log delivery starts every file with a header line
+    if first == "version":
+        return None
+    return message
+
+#generator, egress FlowRecords of one file with start in [start_time, end_time)
+def read_flowlogs(path, start_time=0, end_time=0):
+    with open_flowlog(path) as fh:
+        for line in fh:
+            message = flow_message_from_line(line)
+            if message is None:
+                continue
+            #short and non-egress lines are dropped before any int conversion
+            record = parse_flow(message, get_flowlogs.is_egress_flow)
+            if record is None or record.estart_time is None:
+                continue
+            if record.estart_time < start_time or (end_time and record.estart_time >= end_time):
+                continue
+            yield record
+
+def list_flowlog_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.endswith(".log") or name.endswith(".gz") or name.endswith(".txt"):
+                        files.append(os.path.join(root, name))
+        else:
+            files.append(path)
+    return files
+
+def init_worker(use_ec2):
+    global worker_clients
+    #documents go to the temp files, the service modules' INFO prints must
+    #not end up between them on stdout
+    sys.stdout = sys.stderr
+    ec2_client = None
+    if use_ec2:
+        ec2_client = get_flowlogs.aws_client('ec2')
+    worker_clients = [None, ec2_client]
+    if use_ec2:
+        get_flowlogs.get_ec2_index(worker_clients).refresh_if_stale()
+
+#enriches one file into a temp NDJSON file, the parent streams it out
+def process_file(task):
+    path, start_time, end_time, tmp_dir = task
+    count = 0
+    fd, out_path = tempfile.mkstemp(dir=tmp_dir, suffix=".ndjson")
+    with os.fdopen(fd, "w") as out:
+        get_flowlogs.set_doc_output(out)
+        try:
+            for record in read_flowlogs(path, start_time, end_time):
+                get_flowlogs.enrich_push_logs(worker_clients, record)
+                count += 1
+            if os.environ.get("OUTPUT_MODE", get_flowlogs.OUTPUT_MODE) != "raw":
+                get_flowlogs.get_flow_rollup().flush_all()
+            if get_flowlogs.get_flow_sketch() is not None:
+                get_flowlogs.get_flow_sketch().flush_all()
+        except (OSError, EOFError) as e:
+            print ("EXCEPTION: could not read", path, ":", e, file=sys.stderr)
+        finally:
+            get_flowlogs.set_doc_output(None)
+    return path, out_path, count
+
+def main():
+    parser = argparse.ArgumentParser(description="Enrich exported VPC flow log files offline")
+    parser.add_argument("paths", nargs="+", help="flow log files (plain or .gz) or directories")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--start", type=int, default=0, help="epoch seconds, flows starting before are skipped")
+    parser.add_argument("--end", type=int, default=0, help="epoch seconds, flows starting at or after are skipped")
+    parser.add_argument("--ordered", action="store_true", help="write files' output in input order")
+    parser.add_argument("--output", help="NDJSON output file, default stdout")
+    parser.add_argument("--no-ec2", action="store_true", help="skip EC2 instance enrichment")
+    args = parser.parse_args()
+
+    #the service's seen destinations are not the backfill's to update
+    os.environ.setdefault("SKETCH_STATE", "off")
+    files = list_flowlog_files(args.paths)
+    print ("INFO: backfilling", len(files), "files with", args.workers, "workers", file=sys.stderr)
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "w")
+    tmp_dir = tempfile.mkdtemp(prefix="flowlog_backfill")
+    tasks = [(path, args.start, args.end, tmp_dir) for path in files]
+    total = 0
+    try:
+        with Pool(max(1, args.workers), init_worker, (not args.no_ec2,)) as pool:
+            if args.ordered:
+                results = pool.imap(process_file, tasks)
+            else:
+                results = pool.imap_unordered(process_file, tasks)
+            for path, out_path, count in results:
+                with open(out_path, "r") as fh:
+                    shutil.copyfileobj(fh, out)
+                os.remove(out_path)
+                total += count
+                print ("INFO:", path, "egress flows:", count, file=sys.stderr)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if out is not sys.stdout:
+            out.close()
+    print ("INFO: Total egress flows:", total, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
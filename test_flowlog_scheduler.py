@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import threading
+import unittest
+from unittest import mock
+from botocore.exceptions import ClientError
+from bench_flowlogs import FlowGenerator, ApiStats, FakeLogsClient
+from flowlog_scheduler import (CallScheduler, ScheduledClient, THROTTLE_DECREASE,
+    MIN_RATE_FACTOR, RATE_INCREASE)
+
+#throttles the calls whose schedule entry is True and fails those whose
+#entry is an error code, in call order; calls beyond the schedule succeed
+class ScheduledThrottleStats(ApiStats):
+    def __init__(self, schedule):
+        ApiStats.__init__(self)
+        self.schedule = list(schedule)
+
+    def call(self, api, latency, throttle_rate, rng):
+        with self.lock:
+            entry = self.schedule.pop(0) if self.schedule else False
+        ApiStats.call(self, api, latency, 1.0 if entry is True else 0.0, rng)
+        if entry and entry is not True:
+            raise ClientError({"Error": {"Code": entry, "Message": entry}}, api)
+
+#describe_log_streams waits for gate, so callers pile up behind the first one
+class GatedLogsClient(FakeLogsClient):
+    def __init__(self, streams, stats):
+        FakeLogsClient.__init__(self, streams, stats)
+        self.gate = threading.Event()
+
+    def describe_log_streams(self, **kwargs):
+        self.gate.wait(5)
+        return FakeLogsClient.describe_log_streams(self, **kwargs)
+
+class CallSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.streams = FlowGenerator(enis=3).events(30)
+        self.sleeps = []
+        #backoff at its upper bound and no real sleeping, so waits are exact
+        patches = [mock.patch("flowlog_scheduler.random.uniform", lambda low, high: high),
+            mock.patch("flowlog_scheduler.time.sleep", self.sleeps.append)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def client(self, schedule, rate=0, **kwargs):
+        stats = ScheduledThrottleStats(schedule)
+        scheduler = CallScheduler({"describe_log_streams": rate}, **kwargs)
+        return ScheduledClient(FakeLogsClient(self.streams, stats), scheduler), scheduler, stats
+
+    def test_throttles_are_retried_with_capped_backoff(self):
+        client, scheduler, stats = self.client([True] * 5, max_retries=8,
+            backoff_base=0.2, backoff_max=1.0)
+        response = client.describe_log_streams(logGroupName="flows")
+        self.assertEqual(len(response["logStreams"]), 3)
+        self.assertEqual(stats.calls["describe_log_streams"], 6)
+        api_stats = scheduler.stats()["describe_log_streams"]
+        self.assertEqual((api_stats["calls"], api_stats["throttles"], api_stats["retries"],
+            api_stats["errors"]), (6, 5, 5, 0))
+        self.assertEqual(self.sleeps, [0.2, 0.4, 0.8, 1.0, 1.0])
+
+    def test_gives_up_after_max_retries(self):
+        client, scheduler, stats = self.client([True] * 10, max_retries=3)
+        with self.assertRaises(ClientError):
+            client.describe_log_streams(logGroupName="flows")
+        self.assertEqual(stats.calls["describe_log_streams"], 4)
+        api_stats = scheduler.stats()["describe_log_streams"]
+        self.assertEqual((api_stats["retries"], api_stats["errors"]), (3, 1))
+
+    def test_transient_errors_are_retried_without_lowering_the_rate(self):
+        client, scheduler, stats = self.client(["ServiceUnavailableException", "InternalFailure"],
+            1000, backoff_base=0.2)
+        client.describe_log_streams(logGroupName="flows")
+        api_stats = scheduler.stats()["describe_log_streams"]
+        self.assertEqual((api_stats["calls"], api_stats["throttles"], api_stats["retries"],
+            api_stats["errors"]), (3, 0, 2, 0))
+        self.assertEqual(self.sleeps, [0.2, 0.4])
+        self.assertEqual(scheduler.buckets["describe_log_streams"].rate, 1000)
+
+    def test_other_errors_are_not_retried(self):
+        client, scheduler, stats = self.client(["AccessDeniedException"])
+        with self.assertRaises(ClientError):
+            client.describe_log_streams(logGroupName="flows")
+        self.assertEqual(stats.calls["describe_log_streams"], 1)
+
+    def test_rate_drops_on_throttles_and_recovers(self):
+        rate = 1000
+        client, scheduler, stats = self.client([True, True], rate)
+        client.describe_log_streams(logGroupName="flows")
+        dropped = rate * THROTTLE_DECREASE ** 2 + rate * RATE_INCREASE
+        self.assertAlmostEqual(scheduler.buckets["describe_log_streams"].rate, dropped)
+        recovery = 0
+        while scheduler.buckets["describe_log_streams"].rate < rate:
+            client.describe_log_streams(logGroupName="flows")
+            recovery += 1
+        self.assertEqual(recovery, math.ceil((rate - dropped) / (rate * RATE_INCREASE)))
+        self.assertEqual(scheduler.buckets["describe_log_streams"].rate, rate)
+
+    def test_rate_stays_above_floor(self):
+        rate = 1000
+        client, scheduler, stats = self.client([True] * 20, rate, max_retries=20)
+        client.describe_log_streams(logGroupName="flows")
+        self.assertAlmostEqual(scheduler.buckets["describe_log_streams"].rate,
+            rate * MIN_RATE_FACTOR + rate * RATE_INCREASE)
+
+    def test_concurrent_identical_calls_are_collapsed(self):
+        stats = ScheduledThrottleStats([])
+        logs_client = GatedLogsClient(self.streams, stats)
+        scheduler = CallScheduler({"describe_log_streams": 0})
+        client = ScheduledClient(logs_client, scheduler)
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(
+            client.describe_log_streams(logGroupName="flows"))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while scheduler.stats()["describe_log_streams"]["coalesced"] < 4 and time.monotonic() < deadline:
+            #time.sleep is patched
+            threading.Event().wait(0.01)
+        logs_client.gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(stats.calls["describe_log_streams"], 1)
+        self.assertEqual(scheduler.stats()["describe_log_streams"]["coalesced"], 4)
+        self.assertEqual(len(responses), 5)
+        self.assertTrue(all(response is responses[0] for response in responses))
+
+if __name__ == '__main__':
+    unittest.main()